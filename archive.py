@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Streaming access to source archives, without extracting them to disk.
+
+Supported: tar (plain, gz, bz2, xz, zst), zip, and rpm/src.rpm (cpio
+payload). Archives nested inside archives are scanned recursively.
+
+members() yields file objects that are only valid until the next iteration,
+because tar and rpm are read as a stream.
+"""
+import bz2
+import gzip
+import io
+import lzma
+import posixpath
+import shutil
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2',
+                '.tar.xz', '.txz', '.tar.zst', '.tzst')
+ZSTD_SUFFIXES = ('.tar.zst', '.tzst')
+ZIP_SUFFIXES = ('.zip',)
+RPM_SUFFIXES = ('.rpm',)
+ARCHIVE_SUFFIXES = TAR_SUFFIXES + ZIP_SUFFIXES + RPM_SUFFIXES
+
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+RPM_HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+CPIO_MAGICS = (b'070701', b'070702')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# Errors from corrupt or unsupported (nested) archives
+ARCHIVE_ERRORS = (ArchiveError, tarfile.TarError, zipfile.BadZipFile,
+                  EOFError, OSError, ValueError, lzma.LZMAError)
+
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def members(fileobj, name, match, on_error=None, prune=()):
+    """Yields (path, fileobj) for all regular files that satisfy
+    match(basename, size), skipping those below a directory named in prune.
+
+    Nested archives are entered recursively, their members are reported as
+    "outer/path/inner.tar.gz/inner/path". Errors in nested archives are
+    passed to on_error(path, exception) if given, otherwise raised."""
+    lname = name.lower()
+    if lname.endswith(ZIP_SUFFIXES):
+        reader = _zip_members
+    elif lname.endswith(RPM_SUFFIXES):
+        reader = _rpm_members
+    elif lname.endswith(TAR_SUFFIXES):
+        reader = _tar_members
+    else:
+        raise ArchiveError(f"{name}: unknown archive type")
+    yield from reader(fileobj, name, match, on_error, frozenset(prune))
+
+
+def _member(path, size, fileobj, match, on_error, prune):
+    while path.startswith('./'):
+        path = path[2:]
+    if prune and not prune.isdisjoint(path.split('/')[:-1]):
+        return
+    basename = posixpath.basename(path)
+    if is_archive(basename):
+        try:
+            for inner_path, f in members(fileobj, basename, match, on_error,
+                                         prune):
+                yield f"{path}/{inner_path}", f
+        except ARCHIVE_ERRORS as e:
+            if on_error is None:
+                raise
+            on_error(path, e)
+    elif match(basename, size):
+        yield path, fileobj
+
+
+def _tar_members(fileobj, name, match, on_error, prune):
+    mode = 'r|*'
+    if name.lower().endswith(ZSTD_SUFFIXES):
+        fileobj = zstd_reader(fileobj)
+        mode = 'r|'
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for info in tar:
+            if info.isfile():
+                yield from _member(info.name, info.size,
+                                   tar.extractfile(info), match, on_error,
+                                   prune)
+
+
+def _zip_members(fileobj, name, match, on_error, prune):
+    if not _seekable(fileobj):
+        # zip needs random access, nested zips are buffered in memory
+        fileobj = io.BytesIO(fileobj.read())
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            with zf.open(info) as f:
+                yield from _member(info.filename, info.file_size, f, match,
+                                   on_error, prune)
+
+
+def _rpm_members(fileobj, name, match, on_error, prune):
+    """rpm: lead, signature header, header, compressed cpio payload"""
+    lead = _read_exact(fileobj, 96)
+    if lead[:4] != RPM_LEAD_MAGIC:
+        raise ArchiveError(f"{name}: not an rpm")
+    _skip_rpm_header(fileobj, name, align=True)  # signature
+    _skip_rpm_header(fileobj, name, align=False)
+    payload = decompressed(fileobj)
+    yield from _cpio_members(payload, name, match, on_error, prune)
+
+
+def _skip_rpm_header(fileobj, name, align):
+    intro = _read_exact(fileobj, 16)
+    if intro[:4] != RPM_HEADER_MAGIC:
+        raise ArchiveError(f"{name}: bad rpm header")
+    nindex, hsize = struct.unpack('>II', intro[8:16])
+    size = 16 + nindex * 16 + hsize
+    if align:
+        size += -size % 8
+    _read_exact(fileobj, size - 16)
+
+
+def _cpio_members(fileobj, name, match, on_error, prune):
+    """cpio "new ASCII" format as used by rpm"""
+    while True:
+        header = _read_exact(fileobj, 110)
+        if header[:6] not in CPIO_MAGICS:
+            raise ArchiveError(f"{name}: bad cpio header")
+        mode = int(header[14:22], 16)
+        filesize = int(header[54:62], 16)
+        namesize = int(header[94:102], 16)
+        path = _read_exact(fileobj, namesize)[:-1].decode(
+                errors='surrogateescape')
+        _read_exact(fileobj, -(110 + namesize) % 4)
+        if path == 'TRAILER!!!':
+            return
+        data = _LimitedReader(fileobj, filesize)
+        if stat.S_ISREG(mode):
+            yield from _member(path, filesize, io.BufferedReader(data),
+                               match, on_error, prune)
+        data.drain()
+        _read_exact(fileobj, -filesize % 4)
+
+
+def decompressed(fileobj):
+    """Decompresses a stream, detecting the format by its magic bytes."""
+    magic = fileobj.read(6)
+    stream = io.BufferedReader(_PrefixedReader(magic, fileobj))
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj=stream)
+    if magic.startswith(b'\xfd7zXZ\x00') or magic.startswith(b'\x5d\x00'):
+        return lzma.LZMAFile(stream)
+    if magic.startswith(b'BZh'):
+        return bz2.BZ2File(stream)
+    if magic.startswith(b'\x28\xb5\x2f\xfd'):
+        return zstd_reader(stream)
+    return stream
+
+
+def zstd_reader(fileobj):
+    """zstd decompression with the zstandard module or the zstd binary"""
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    zstd = shutil.which("zstd")
+    if zstd is None:
+        raise ArchiveError("zstd support requires the zstandard module or "
+                           "the zstd binary")
+    proc = subprocess.Popen([zstd, "-dc"], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin)
+        except (BrokenPipeError, ValueError):
+            pass  # the reader stopped early
+        finally:
+            proc.stdin.close()
+
+    threading.Thread(target=feed, daemon=True).start()
+    return proc.stdout
+
+
+def _seekable(fileobj):
+    try:
+        return fileobj.seekable()
+    except (AttributeError, OSError):
+        # tarfile's stream mode doesn't implement seekable() properly
+        return False
+
+
+def _read_exact(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ArchiveError("unexpected end of archive")
+    return data
+
+
+class _PrefixedReader(io.RawIOBase):
+    """Stream that returns `prefix` followed by the rest of `fileobj`."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self.prefix:
+            data = self.prefix[:len(buf)]
+            self.prefix = self.prefix[len(data):]
+        else:
+            data = self.fileobj.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class _LimitedReader(io.RawIOBase):
+    """The next `size` bytes of `fileobj`."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self.fileobj.read(min(len(buf), self.remaining))
+        self.remaining -= len(data)
+        buf[:len(data)] = data
+        return len(data)
+
+    def drain(self):
+        while self.remaining > 0:
+            data = self.fileobj.read(min(self.remaining, 1 << 20))
+            if not data:
+                raise ArchiveError("unexpected end of archive")
+            self.remaining -= len(data)
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Reproducible benchmark of the identify.py client.
+
+Generates a synthetic source tree and a synthetic database in a work
+directory, both derived from a seed, so every run on every machine scans the
+same data. A configurable fraction of the tree's files is indexed, the
+other database rows are random hashes. Each scan runs in a fresh process, so
+its peak RSS is its own:
+
+    ./benchmark.py --files 20000 --match-ratio 0.05 -j 1 -j 4
+    ./benchmark.py --save-baseline baseline.json
+    ./benchmark.py --baseline baseline.json   # exit code 1 on regressions
+
+Reported per --jobs value (median of --repeat scans): files/s (walked
+files), MB/s (hashed bytes), peak RSS, and the latency of lookups of a
+single hash and of a full batch.
+"""
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import time
+
+import bloom
+import db
+import identify
+
+
+# Metrics compared with the baseline: (name, True if higher is better)
+METRICS = [
+    ("files_per_s", True),
+    ("mb_per_s", True),
+    ("wall_s", False),
+    ("peak_rss_mb", False),
+    ("lookup_ms", False),
+    ("batch_lookup_ms", False),
+]
+
+LOOKUP_SAMPLES = 200
+
+
+def generate(directory, files, match_ratio, size, db_rows, seed):
+    """Writes the tree (directory/tree) and database (directory/db.sqlite
+    plus its prefilter). Skipped if they exist for the same parameters."""
+    params = {"files": files, "match_ratio": match_ratio, "size": size,
+              "db_rows": db_rows, "seed": seed,
+              "bloom_version": bloom.VERSION}
+    params_path = os.path.join(directory, "params.json")
+    try:
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return
+    except (OSError, ValueError):
+        pass
+    print(f"Generating {files} files in {directory}", file=sys.stderr)
+    shutil.rmtree(directory, ignore_errors=True)
+    tree = os.path.join(directory, "tree")
+    rng = random.Random(seed)
+    rows = []
+    for i in range(files):
+        subdir = os.path.join(tree, f"d{i // 100:04d}")
+        if i % 100 == 0:
+            os.makedirs(subdir)
+        # lognormal sizes, like real source files
+        file_size = min(int(rng.lognormvariate(math.log(size), 1)), 1 << 20)
+        name = f"f{i}.{rng.choice(('c', 'h', 'cpp'))}"
+        data = (f"/* {i} */\n".encode() +
+                rng.randbytes(file_size // 2).hex().encode())
+        with open(os.path.join(subdir, name), "wb") as f:
+            f.write(data)
+        if rng.random() < match_ratio:
+            rows.append((hashlib.sha256(data).digest(), f"lib{i % 50}",
+                         f"{i:040x}", "2024-01-01T00:00:00", f"v{i}",
+                         f"src/{name}", len(data)))
+        if i % 5 == 0:  # files that are never hashed
+            with open(os.path.join(subdir, f"f{i}.txt"), "wb") as f:
+                f.write(b"x" * 100)
+    for i in range(db_rows):
+        file_size = min(int(rng.lognormvariate(math.log(size), 1)), 1 << 20)
+        rows.append((rng.randbytes(32), f"lib{i % 50}", f"{i:040x}",
+                     "2023-01-01T00:00:00", f"v{i}", f"src/r{i}.c",
+                     file_size))
+
+    db_path = os.path.join(directory, "db.sqlite")
+    con = sqlite3.connect(db_path)
+    db.create(con)
+    con.executemany("INSERT OR IGNORE INTO files VALUES (?,?,?,?,?,?,?)",
+                    rows)
+    con.commit()
+    db.update_names(con)
+    db.new_generation(con)
+    bloom.build(con).write(f"{db_path}.bloom")
+    con.close()
+    with open(params_path, "w") as f:
+        json.dump(params, f)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def measure(directory, jobs, file_filter, prefilter):
+    """One scan in this process. Returns the metrics as dict."""
+    db_path = os.path.join(directory, "db.sqlite")
+    start = time.perf_counter()
+    with identify.Scanner(db_path, jobs=jobs, file_filter=file_filter,
+                          prefilter=prefilter) as scanner:
+        findings = sum(1 for _ in scanner.scan(os.path.join(directory,
+                                                            "tree")))
+        wall = time.perf_counter() - start
+        stats = scanner.stats.as_dict()
+
+        # lookup latency: half known, half unknown hashes
+        known = [sha256 for (sha256,) in scanner.con.execute(
+            "SELECT sha256 FROM files LIMIT ?", (LOOKUP_SAMPLES // 2,))]
+        rng = random.Random(0)
+        sample = known + [rng.randbytes(32)
+                          for _ in range(LOOKUP_SAMPLES - len(known))]
+        single = []
+        for sha256 in sample:
+            t = time.perf_counter()
+            scanner.lookup_batch([sha256])
+            single.append(time.perf_counter() - t)
+        batches = []
+        for _ in range(20):
+            batch = rng.sample(sample, len(sample))
+            batch = (batch * (identify.BATCH_SIZE // len(batch) + 1)
+                     )[:identify.BATCH_SIZE]
+            t = time.perf_counter()
+            scanner.lookup_batch(batch)
+            batches.append(time.perf_counter() - t)
+
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        rss *= 1024
+    return {
+        "findings": findings,
+        "files_walked": stats["files_walked"],
+        "files_hashed": stats["files_hashed"],
+        "wall_s": wall,
+        "files_per_s": stats["files_walked"] / wall,
+        "mb_per_s": stats["bytes_hashed"] / 1e6 / wall,
+        "peak_rss_mb": rss / 1e6,
+        "lookup_ms": statistics.median(single) * 1e3,
+        "lookup_p95_ms": percentile(single, 0.95) * 1e3,
+        "batch_lookup_ms": statistics.median(batches) * 1e3,
+    }
+
+
+def _measure_child(conn, *args):
+    conn.send(measure(*args))
+    conn.close()
+
+
+def measure_isolated(*args):
+    """measure() in a fresh process, so the peak RSS is the scan's own."""
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_measure_child, args=(child,) + args)
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def run(args):
+    generate(args.dir, args.files, args.match_ratio, args.size, args.db_rows,
+             args.seed)
+    results = {
+        "params": {"files": args.files, "match_ratio": args.match_ratio,
+                   "size": args.size, "db_rows": args.db_rows,
+                   "seed": args.seed, "filter": args.filter,
+                   "prefilter": not args.no_prefilter},
+        "machine": {"python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "runs": {},
+    }
+    for jobs in args.jobs:
+        samples = [measure_isolated(args.dir, jobs, args.filter,
+                                    not args.no_prefilter)
+                   for _ in range(args.repeat)]
+        median = {key: statistics.median(s[key] for s in samples)
+                  for key in samples[0]}
+        results["runs"][str(jobs)] = median
+    return results
+
+
+def print_results(results):
+    print(f"{'jobs':>4}  {'files/s':>10}  {'MB/s':>8}  {'wall s':>8}  "
+          f"{'RSS MB':>8}  {'lookup ms':>9}  {'p95 ms':>8}  {'batch ms':>8}")
+    for jobs, r in results["runs"].items():
+        print(f"{jobs:>4}  {r['files_per_s']:10.0f}  {r['mb_per_s']:8.1f}  "
+              f"{r['wall_s']:8.3f}  {r['peak_rss_mb']:8.1f}  "
+              f"{r['lookup_ms']:9.3f}  {r['lookup_p95_ms']:8.3f}  "
+              f"{r['batch_lookup_ms']:8.3f}")
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of every metric relative to the baseline. Returns
+    the number of regressions beyond the tolerance (fraction)."""
+    if baseline["params"] != results["params"]:
+        print("warning: the baseline was measured with different parameters: "
+              f"{baseline['params']}", file=sys.stderr)
+    if baseline["machine"] != results["machine"]:
+        print("warning: the baseline was measured on a different machine: "
+              f"{baseline['machine']}", file=sys.stderr)
+    regressions = 0
+    print()
+    print(f"{'jobs':>4}  {'metric':16s}  {'baseline':>10}  {'current':>10}  "
+          f"{'change':>8}")
+    for jobs, r in results["runs"].items():
+        base = baseline["runs"].get(jobs)
+        if base is None:
+            continue
+        for name, higher_is_better in METRICS:
+            if not base.get(name):
+                continue
+            change = r[name] / base[name] - 1
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{jobs:>4}  {name:16s}  {base[name]:10.3f}  "
+                  f"{r[name]:10.3f}  {change:+8.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            prog="benchmark.py",
+            description="Benchmark identify.py on a synthetic tree and "
+            "database")
+    parser.add_argument("--dir", default="bench",
+                        help="work directory for the generated tree and "
+                        "database, reused if the parameters are unchanged. "
+                        "Default: ./bench")
+    parser.add_argument("--files", type=int, default=10000,
+                        help="number of C/C++ files in the tree. "
+                        "Default: 10000")
+    parser.add_argument("--match-ratio", type=float, default=0.05,
+                        help="fraction of the files that are indexed. "
+                        "Default: 0.05")
+    parser.add_argument("--size", type=int, default=4096,
+                        help="median file size in bytes. Default: 4096")
+    parser.add_argument("--db-rows", type=int, default=100000,
+                        help="number of additional, unrelated database "
+                        "rows. Default: 100000")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-j", "--jobs", type=int, action="append",
+                        help="hashing threads, can be given multiple times. "
+                        "Default: 1")
+    parser.add_argument("--filter", choices=["none", "size", "name"],
+                        default="size", help="see identify.py --filter")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="don't use the Bloom filter")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="scans per --jobs value, the median is "
+                        "reported. Default: 3")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with the results in FILE, exit code 1 "
+                        "on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown before a change counts as a "
+                        "regression. Default: 0.1 (10%%)")
+    parser.add_argument("--save-baseline", metavar="FILE",
+                        help="write the results to FILE")
+    args = parser.parse_args()
+    args.jobs = args.jobs or [1]
+
+    results = run(args)
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
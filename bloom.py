@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Bloom filter over SHA-256 digests.
+
+identify.py uses it to skip database lookups for hashes that are definitely
+not indexed. The keys are SHA-256 digests, which are uniformly distributed
+already, so the probe positions are derived from the digest bytes directly
+(double hashing) instead of hashing the key again.
+
+A filter belongs to one generation of the database (db.generation()), a
+filter of another generation would miss the hashes added since.
+
+File format, little endian:
+    8 bytes   magic b"IDLBLOOM"
+    4 bytes   format version
+    4 bytes   number of probes (k)
+    8 bytes   number of bits (m)
+    8 bytes   number of keys (n)
+    32 bytes  database generation, ASCII hex
+    m/8 bytes bit array
+"""
+import math
+import mmap
+import struct
+
+import db
+
+
+MAGIC = b"IDLBLOOM"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQQ32s")
+PROBE_SEEDS = struct.Struct("<QQ")  # h1, h2 of the double hashing
+
+
+class BloomFilter:
+    def __init__(self, bits, num_bits, num_hashes, num_keys=0, offset=0,
+                 generation=None):
+        self.bits = bits
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.num_keys = num_keys
+        self.offset = offset
+        self.generation = generation
+
+    @classmethod
+    def create(cls, num_keys, fp_rate=0.01):
+        """Empty filter sized for num_keys keys and the given false positive
+        rate."""
+        n = max(num_keys, 1)
+        num_bits = math.ceil(-n * math.log(fp_rate) / math.log(2) ** 2)
+        num_bits = (num_bits + 7) // 8 * 8
+        num_hashes = max(1, round(num_bits / n * math.log(2)))
+        return cls(bytearray(num_bits // 8), num_bits, num_hashes)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a filter written by write()."""
+        with open(path, "rb") as f:
+            bits = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(bits) < HEADER.size:
+            raise ValueError(f"{path}: not a bloom filter")
+        magic, version = HEADER.unpack_from(bits)[:2]
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a bloom filter")
+        if version != VERSION:
+            raise ValueError(f"{path}: unsupported version {version}")
+        _, _, num_hashes, num_bits, num_keys, generation = \
+            HEADER.unpack_from(bits)
+        if len(bits) != HEADER.size + num_bits // 8:
+            raise ValueError(f"{path}: truncated")
+        return cls(bits, num_bits, num_hashes, num_keys, HEADER.size,
+                   generation.decode("ascii"))
+
+    def write(self, path):
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.num_hashes,
+                                self.num_bits, self.num_keys,
+                                (self.generation or "").encode("ascii")))
+            f.write(self.bits)
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[0:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.num_keys += 1
+
+    def __contains__(self, digest):
+        return bool(self.filter((digest,)))
+
+    def filter(self, digests):
+        """The digests that may be in the set, in their order.
+
+        A miss usually fails on the first or second probe, so the probes are
+        inlined instead of going through _positions()."""
+        bits, offset = self.bits, self.offset
+        num_bits, num_hashes = self.num_bits, self.num_hashes
+        unpack = PROBE_SEEDS.unpack_from
+        result = []
+        for digest in digests:
+            h1, h2 = unpack(digest)
+            h2 |= 1
+            for _ in range(num_hashes):
+                pos = h1 % num_bits
+                if not bits[offset + (pos >> 3)] >> (pos & 7) & 1:
+                    break
+                h1 += h2
+            else:
+                result.append(digest)
+        return result
+
+
+def build(con, fp_rate=0.01):
+    """Filter over all hashes in a (schema v2) database, for its current
+    generation."""
+    num_keys = con.execute("SELECT COUNT(DISTINCT sha256) FROM files"
+                           ).fetchone()[0]
+    bf = BloomFilter.create(num_keys, fp_rate)
+    bf.generation = db.generation(con)
+    for (sha256,) in con.execute("SELECT DISTINCT sha256 FROM files"):
+        bf.add(sha256)
+    return bf
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
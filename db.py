@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Database schema and schema versioning."""
+import posixpath
+import sqlite3
+import uuid
+
+
+SCHEMA_VERSION = 2
+
+# Version 1 stored the hash as hex TEXT in a rowid table plus a secondary
+# index. Kept for reference and for migrate.py.
+SCHEMA_V1 = '''
+CREATE TABLE IF NOT EXISTS files (
+    sha256      TEXT,
+    library     TEXT,     -- name of the library
+    commit_hash TEXT,     -- git commit that introduced this version
+    commit_time TEXT,     -- git commit timestamp (ISO 8601 format)
+    commit_desc TEXT,     -- git describe for this commit,
+                          -- ... falls back to: 0^{date}.{commit_hash}
+    path        TEXT,     -- file path at the time of the matched commit
+    size        INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_sha256_index ON files(sha256);
+CREATE INDEX IF NOT EXISTS files_library_index ON files(library);
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    sha256      BLOB NOT NULL,  -- SHA-256, 32 bytes binary
+    library     TEXT NOT NULL,  -- name of the library
+    commit_hash TEXT NOT NULL,  -- git commit that introduced this version
+    commit_time TEXT,           -- git commit timestamp (ISO 8601 format)
+    commit_desc TEXT,           -- git describe for this commit,
+                                -- ... falls back to: 0^{date}.{commit_hash}
+    path        TEXT NOT NULL,  -- file path at the time of the matched commit
+    size        INTEGER,
+    PRIMARY KEY (sha256, library, commit_hash, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_library_index ON files(library);
+
+-- Basenames and sizes of all indexed files, for the client's prefilter.
+-- Derived from files, see update_names().
+CREATE TABLE IF NOT EXISTS names (
+    name        TEXT NOT NULL,  -- basename of files.path
+    size        INTEGER NOT NULL,
+    PRIMARY KEY (name, size)
+) WITHOUT ROWID;
+
+-- Tagged releases of each library, numbered by commit time.
+CREATE TABLE IF NOT EXISTS releases (
+    library     TEXT NOT NULL,
+    id          INTEGER NOT NULL,  -- bit number in containment.releases
+    tag         TEXT NOT NULL,
+    commit_time TEXT,
+    PRIMARY KEY (library, id)
+) WITHOUT ROWID;
+
+-- Which releases contain a file: bit i of releases (little endian) is set
+-- if the tree of release i contains the blob.
+CREATE TABLE IF NOT EXISTS containment (
+    sha256      BLOB NOT NULL,
+    library     TEXT NOT NULL,
+    releases    BLOB NOT NULL,
+    PRIMARY KEY (sha256, library)
+) WITHOUT ROWID;
+
+-- Hashes of the normalized contents of indexed files, for copies that were
+-- reformatted. Optional, filled by index.py --normalized.
+CREATE TABLE IF NOT EXISTS normalized (
+    sha256            BLOB NOT NULL,  -- files.sha256
+    whitespace_sha256 BLOB NOT NULL,  -- of normalize.normalize_whitespace()
+    normalized_sha256 BLOB,           -- of normalize.normalize(), NULL if
+                                      -- only the whitespace tier was indexed
+    PRIMARY KEY (sha256)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS normalized_whitespace_index
+    ON normalized(whitespace_sha256);
+CREATE INDEX IF NOT EXISTS normalized_sha256_index
+    ON normalized(normalized_sha256);
+
+-- MinHash signatures of indexed files and their LSH bands, for similarity
+-- lookups of patched copies (see minhash.py). Optional, filled by
+-- index.py --minhash.
+CREATE TABLE IF NOT EXISTS minhash (
+    sha256      BLOB NOT NULL,  -- files.sha256
+    signature   BLOB NOT NULL,  -- minhash.NUM_PERM little endian uint32,
+                                -- empty if the file is too short
+    PRIMARY KEY (sha256)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lsh (
+    band        INTEGER NOT NULL,  -- 0 .. minhash.BANDS - 1
+    key         BLOB NOT NULL,     -- the signature values of this band
+    sha256      BLOB NOT NULL,
+    PRIMARY KEY (band, key, sha256)
+) WITHOUT ROWID;
+
+-- Winnowed fingerprints of indexed files, for files concatenated into
+-- amalgamations (see winnow.py). Optional, filled by index.py
+-- --fingerprints.
+CREATE TABLE IF NOT EXISTS fingerprints (
+    hash        INTEGER NOT NULL,  -- winnow.fingerprints() value
+    sha256      BLOB NOT NULL,     -- files.sha256
+    PRIMARY KEY (hash, sha256)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fingerprinted (
+    sha256      BLOB NOT NULL,     -- files.sha256
+    fingerprints INTEGER NOT NULL, -- number of fingerprints of the file,
+                                   -- 0 if it is too short
+    PRIMARY KEY (sha256)
+) WITHOUT ROWID;
+
+-- Identity of the database contents. index.py stores a new random
+-- generation whenever it changes them, the prefilter records the generation
+-- it was built from.
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT NOT NULL,  -- e.g. generation
+    value       TEXT NOT NULL,
+    PRIMARY KEY (key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS libraries (  -- not implemented
+    library     TEXT PRIMARY KEY,
+    git_remote  TEXT,     -- git remote URI
+    summary     TEXT      -- short summary of the library
+);
+'''
+
+# State of index.py for incremental runs, kept in a separate database next
+# to the published one (DB.state), since identify.py never reads it.
+STATE_SCHEMA = '''
+-- Ref tips (branches, tags, HEAD) of each library at its last index.py
+-- run. The next run only indexes commits that aren't reachable from them.
+CREATE TABLE IF NOT EXISTS indexed_refs (
+    library     TEXT NOT NULL,
+    ref         TEXT NOT NULL,  -- e.g. refs/heads/master, refs/tags/v1.0
+    commit_hash TEXT NOT NULL,
+    settings    TEXT NOT NULL,  -- index.py options of the run (JSON), a
+                                -- run with other options rebuilds
+    PRIMARY KEY (library, ref)
+) WITHOUT ROWID;
+
+-- Digests of git blobs, so index.py reads and hashes every blob once, across
+-- libraries and runs. Keyed by content, so entries never go stale.
+CREATE TABLE IF NOT EXISTS blobs (
+    oid         BLOB NOT NULL,  -- git object id, 20 bytes binary
+    sha256      BLOB NOT NULL,
+    size        INTEGER NOT NULL,
+    PRIMARY KEY (oid)
+) WITHOUT ROWID;
+
+-- git describe --tags of every commit of each library as nearest tag and
+-- distance, see GitRepo.describe_all(). Reused by the next index.py run.
+CREATE TABLE IF NOT EXISTS descriptions (
+    library     TEXT NOT NULL,
+    commit_hash TEXT NOT NULL,
+    tag         TEXT,              -- NULL if no tag is reachable
+    depth       INTEGER NOT NULL,  -- commits since the tag
+    PRIMARY KEY (library, commit_hash)
+) WITHOUT ROWID;
+'''
+
+
+def table_exists(con, name):
+    row = con.execute("SELECT name FROM sqlite_master "
+                      "WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+
+def schema_version(con):
+    """Schema version of a database. 0 means empty.
+
+    Version 1 predates the user_version marker, so it is detected by the
+    presence of the files table."""
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version > 0:
+        return version
+    if table_exists(con, "files"):
+        return 1
+    return 0
+
+
+def create(con):
+    """Creates the current schema. Existing tables are kept."""
+    con.executescript(SCHEMA)
+    con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.commit()
+
+
+def create_state(con):
+    """Creates the schema of an index.py state database. Existing tables are
+    kept."""
+    con.executescript(STATE_SCHEMA)
+    con.commit()
+
+
+def generation(con):
+    """The generation of the database contents, None if it has none."""
+    if not table_exists(con, "meta"):
+        return None
+    row = con.execute("SELECT value FROM meta WHERE key = 'generation'"
+                      ).fetchone()
+    return row[0] if row else None
+
+
+def new_generation(con):
+    """Stores and returns a new generation, after the contents changed."""
+    value = uuid.uuid4().hex
+    con.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)",
+                (value,))
+    con.commit()
+    return value
+
+
+def update_names(con):
+    """Rebuilds the names table from the files table."""
+    con.create_function("basename", 1, posixpath.basename, deterministic=True)
+    con.execute("DELETE FROM names")
+    con.execute("INSERT OR IGNORE INTO names "
+                "SELECT DISTINCT basename(path), size FROM files")
+    con.commit()
+
+
+def migrate_v1_to_v2(con):
+    """In-place migration from hex TEXT keys to binary keys."""
+    con.create_function("unhex", 1, bytes.fromhex, deterministic=True)
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute("BEGIN")
+        con.execute("DROP INDEX IF EXISTS files_sha256_index")
+        con.execute("DROP INDEX IF EXISTS files_library_index")
+        con.execute("ALTER TABLE files RENAME TO files_v1")
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                con.execute(statement)
+        # Exact duplicates collapse into one row with the new primary key.
+        con.execute("INSERT OR IGNORE INTO files "
+                    "SELECT unhex(sha256), library, commit_hash, commit_time, "
+                    "commit_desc, path, size FROM files_v1")
+        con.execute("DROP TABLE files_v1")
+        con.execute("PRAGMA user_version = 2")
+        con.execute("COMMIT")
+        update_names(con)
+        new_generation(con)
+    except sqlite3.Error:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.isolation_level = isolation_level
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import collections
+import heapq
 import os
 import pygit2
 import subprocess
@@ -30,6 +31,38 @@ class GitException(Exception):
     pass
 
 
+def _count_exclusive(parents, sources, target):
+    """Number of commits reachable from sources, but not from target. Commits
+    are indices in topological order, parents[i] lists the parents of i.
+
+    Walks from the highest index down, so the flags of a commit are final
+    when it is taken from the heap, and stops when no commit reachable only
+    from sources is left."""
+    flags = {target: 2}  # 1: reachable from sources, 2: from target
+    for source in sources:
+        flags[source] = flags.get(source, 0) | 1
+    heap = [-i for i in flags]
+    heapq.heapify(heap)
+    pending = sum(1 for f in flags.values() if f == 1)
+    count = 0
+    while pending:
+        i = -heapq.heappop(heap)
+        f = flags[i]
+        if f == 1:
+            count += 1
+            pending -= 1
+        for p in parents[i]:
+            old = flags.get(p, 0)
+            new = old | f
+            if new == old:
+                continue
+            flags[p] = new
+            if old == 0:
+                heapq.heappush(heap, -p)
+            pending += (new == 1) - (old == 1)
+    return count
+
+
 class GitRepo:
     def __init__(self, repo_path):
         if not is_git_repository(repo_path):
@@ -70,10 +103,14 @@ class GitRepo:
         """File contents for commit:path as bytes."""
         # return subprocess.check_output(self.gitcmd + ['show',
         #                                f'{commit}:{path}'])
-        commitobj = self.repo.get(commit)
-        entry = commitobj.tree[path]
-        blob = self.repo[entry.id].data
-        return blob
+        return self.blob_bytes(self.blob_id(commit, path))
+
+    def blob_id(self, commit, path):
+        """Object id of the blob at commit:path, without reading it."""
+        return self.repo.get(commit).tree[path].id
+
+    def blob_bytes(self, blob_id):
+        return self.repo[blob_id].data
 
     def file_text_at_commit(self, commit, path):
         """File contents for commit:path as UTF-8."""
@@ -102,6 +139,153 @@ class GitRepo:
             else:
                 raise e
 
+    def tags(self):
+        """All tags pointing to commits, oldest first.
+        Returns [(tag, commit_hash, commit_time), ...]"""
+        result = []
+        for ref in self.repo.listall_references():
+            if not ref.startswith('refs/tags/'):
+                continue
+            try:
+                commit = self.repo.revparse_single(ref).peel(pygit2.Commit)
+            except (KeyError, ValueError, pygit2.GitError):
+                continue  # tag of a tree or blob
+            commit_hash = str(commit.id)
+            result.append((ref[len('refs/tags/'):], commit_hash,
+                           self.datetime(commit_hash)))
+        result.sort(key=lambda t: t[2])
+        return result
+
+    def tag_names(self):
+        """{commit_hash: tag} of all tagged commits. Like git describe --tags,
+        annotated tags are preferred over lightweight ones, newer annotated
+        tags over older ones, and else the first tag by name."""
+        best = {}  # commit_hash -> (tag, tagger time, None if lightweight)
+        for ref in sorted(self.repo.listall_references()):
+            if not ref.startswith('refs/tags/'):
+                continue
+            try:
+                obj = self.repo.revparse_single(ref)
+                commit = obj.peel(pygit2.Commit)
+            except (KeyError, ValueError, pygit2.GitError):
+                continue  # tag of a tree or blob
+            time = None
+            if isinstance(obj, pygit2.Tag):
+                time = obj.tagger.time if obj.tagger else 0
+            commit_hash = str(commit.id)
+            current = best.get(commit_hash)
+            if current is None or (time is not None and
+                                   (current[1] is None or time > current[1])):
+                best[commit_hash] = (ref[len('refs/tags/'):], time)
+        return {commit_hash: tag for commit_hash, (tag, _) in best.items()}
+
+    def describe_all(self, known=None, stale=()):
+        """git describe --tags of all commits of all refs in a single pass
+        over the history. Returns {commit_hash: (tag, depth)}, where depth is
+        the number of commits reachable from the commit, but not from the
+        tag. tag is None if no tag is reachable.
+
+        The nearest tag of a commit is the nearest tag of one of its
+        parents, instead of git describe's walk over the history of each
+        commit. known: results of a previous call, reused except for the
+        commits in stale (whose tags changed since) and their descendants."""
+        tags = self.tag_names()
+        known = known or {}
+        dirty = set()  # indices of stale commits and their descendants
+        proc = subprocess.run(self.gitcmd + ['rev-list', '--all', '--parents',
+                              '--topo-order', '--reverse'], check=True,
+                              capture_output=True, text=True)
+        commits = []  # in topological order, parents first
+        parents = []  # indices into commits
+        index = {}
+        result = {}
+        for line in proc.stdout.splitlines():
+            commit_hash, *parent_hashes = line.split()
+            i = len(commits)
+            index[commit_hash] = i
+            commits.append(commit_hash)
+            # missing in shallow clones
+            parents.append([index[p] for p in parent_hashes if p in index])
+            if commit_hash in stale or any(p in dirty for p in parents[i]):
+                dirty.add(i)
+            elif commit_hash in known:
+                result[commit_hash] = known[commit_hash]
+                continue
+            if commit_hash in tags:
+                result[commit_hash] = (tags[commit_hash], 0)
+                continue
+            best = (None, 0)
+            for p in parents[i]:
+                tag, depth = result[commits[p]]
+                if tag is None:
+                    continue
+                # merge: add the commits only reachable from the other
+                # parents, the tag is reachable from this one
+                others = [q for q in parents[i] if q != p]
+                depth += 1 + _count_exclusive(parents, others, p)
+                if best[0] is None or depth < best[1]:
+                    best = (tag, depth)
+            result[commit_hash] = best
+        return result
+
+    def format_describe(self, commit, tag, depth):
+        """describe_all() result as string, like git describe --tags."""
+        if depth == 0:
+            return tag
+        return f"{tag}-{depth}-g{self.repo[commit].short_id}"
+
+    def ref_tips(self):
+        """Commits of all refs and HEAD, the starting points of git log
+        --all. Returns {ref: commit_hash}."""
+        result = {}
+        for ref in self.repo.listall_references() + ['HEAD']:
+            try:
+                commit = self.repo.revparse_single(ref).peel(pygit2.Commit)
+            except (KeyError, ValueError, pygit2.GitError):
+                continue  # unborn HEAD, tag of a tree or blob
+            result[ref] = str(commit.id)
+        return result
+
+    def has_commit(self, commit):
+        try:
+            return isinstance(self.repo.get(commit), pygit2.Commit)
+        except ValueError:
+            return False
+
+    def rev_list(self, include, exclude=()):
+        """Commits reachable from include, but not from exclude."""
+        include = list(include)
+        if not include:
+            return []
+        revs = include + ['^' + commit for commit in exclude]
+        cmdline = self.gitcmd + ['rev-list', '--stdin']
+        proc = subprocess.run(cmdline, input='\n'.join(revs), check=True,
+                              capture_output=True, text=True)
+        return proc.stdout.split()
+
+    def tree_blobs(self, commit, paths=None):
+        """Yields (path, blob_id) for the files in the tree of a commit.
+        If paths is given, only these paths are considered."""
+        tree = self.repo.get(commit).tree
+        if paths is not None:
+            for path in paths:
+                try:
+                    entry = tree[path]
+                except KeyError:
+                    continue
+                if entry.type_str == 'blob':
+                    yield path, entry.id
+            return
+        stack = [('', tree)]
+        while stack:
+            prefix, tree = stack.pop()
+            for entry in tree:
+                if entry.type_str == 'tree':
+                    stack.append((prefix + entry.name + '/',
+                                  self.repo[entry.id]))
+                elif entry.type_str == 'blob':
+                    yield prefix + entry.name, entry.id
+
     def datetime(self, commit):
         # time_str = subprocess.check_output(self.gitcmd + ['show',
         #                                    '--no-patch', '--format=%ci',
@@ -128,18 +312,24 @@ class GitRepo:
                               'HEAD'], capture_output=True, text=True)
         return int(proc.stdout.strip())
 
-    def all_commits_with_metadata(self, path=None, describe=False) -> list[CommitInfo]:
+    def all_commits_with_metadata(self, path=None, describe=False,
+                                  exclude=()) -> list[CommitInfo]:
+        """Commits of all refs that add or modify files (or path), except
+        those reachable from the commits in exclude."""
         result = []
         cmdline = self.gitcmd + ['log', '--all', '--name-only', '--date=iso',
                                  '--diff-filter=AMR', '--ignore-submodules',
-                                 '-z']
+                                 '-z', '--stdin']
         if describe:
             cmdline += ['--format=format:%(describe:tags) %H %ad']
         else:
             cmdline += ['--format=format:%H %ad']
         if path:
             cmdline += ['--follow', path]
-        proc = subprocess.run(cmdline, capture_output=True, text=True)
+        # on stdin, the list of tips can be longer than a command line
+        proc = subprocess.run(cmdline, capture_output=True, text=True,
+                              input=''.join(f'^{commit}\n'
+                                            for commit in exclude))
         # First line: {tag} {commit_hash} {commit_time}
         # {tag} may be empty
         """
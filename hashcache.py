@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Persistent SHA-256 cache for files on disk.
+
+An entry is valid as long as the file's path, device, inode, size and
+mtime are unchanged, so rescans of unchanged trees only need to stat()
+files. Least recently used entries are evicted when the cache grows beyond
+its size limit.
+"""
+import os
+import sqlite3
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    path        TEXT PRIMARY KEY,  -- absolute path
+    dev         INTEGER,
+    ino         INTEGER,
+    size        INTEGER,
+    mtime_ns    INTEGER,
+    sha256      BLOB,
+    last_used   INTEGER            -- unix time of the last scan using it
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hashes_last_used_index ON hashes(last_used);
+'''
+
+# Files modified this recently are not cached: a change within the same
+# mtime tick would go unnoticed (cf. "racy git").
+RACY_NS = 2 * 10**9
+
+# Pending inserts or last_used updates that trigger a flush()
+FLUSH_SIZE = 10000
+
+
+class HashCache:
+    def __init__(self, path, max_entries=1_000_000):
+        self.con = sqlite3.connect(path)
+        self.con.executescript(SCHEMA)
+        self.max_entries = max_entries
+        # number of entries, an upper bound between evict() calls since
+        # put() may replace known paths
+        self.count = self.con.execute("SELECT COUNT(*) FROM hashes"
+                                      ).fetchone()[0]
+        self.begin()
+        self.new = []
+        self.used = []
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self):
+        """Starts a scan: entries get this time as last_used, and files
+        modified before the last RACY_NS can be cached. Called for every
+        scan of a long-running process like the server."""
+        self.now = int(time.time())
+        self.racy_limit_ns = time.time_ns() - RACY_NS
+
+    def get(self, path, st):
+        """Cached digest for `path` with stat result `st`, or None."""
+        path = os.path.abspath(path)
+        row = self.con.execute(
+                "SELECT sha256 FROM hashes WHERE path = ? AND dev = ? AND "
+                "ino = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_dev, st.st_ino, st.st_size,
+                 st.st_mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((self.now, path))
+        if len(self.used) >= FLUSH_SIZE:
+            self.flush()
+        return row[0]
+
+    def put(self, path, st, sha256):
+        if st.st_mtime_ns >= self.racy_limit_ns:
+            return
+        self.new.append((os.path.abspath(path), st.st_dev, st.st_ino,
+                         st.st_size, st.st_mtime_ns, sha256, self.now))
+        if len(self.new) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.con.executemany("INSERT OR REPLACE INTO hashes "
+                             "VALUES (?,?,?,?,?,?,?)", self.new)
+        self.con.executemany("UPDATE hashes SET last_used = ? "
+                             "WHERE path = ?", self.used)
+        self.con.commit()
+        self.count += len(self.new)
+        self.new = []
+        self.used = []
+        # long-running processes like the server never close() the cache
+        if self.count > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """Drops the least recently used entries beyond max_entries."""
+        count = self.con.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self.max_entries:
+            self.con.execute("DELETE FROM hashes WHERE path IN "
+                             "(SELECT path FROM hashes "
+                             "ORDER BY last_used LIMIT ?)",
+                             (count - self.max_entries,))
+            self.con.commit()
+            count = self.max_entries
+        self.count = count
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.con.close()
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
@@ -1,75 +1,1403 @@
 #!/usr/bin/env python3
+"""Identify embedded open-source libraries.
+
+Command line tool, but also usable as a library:
+
+    from identify import Scanner
+
+    with Scanner("idlib.sqlite", jobs=4) as scanner:
+        for finding in scanner.scan("cmake-3.29.2"):
+            print(finding.row.library, finding.row.commit_desc,
+                  finding.rel_path)
+
+A Scanner keeps the database connection, prefilters, hash cache and thread
+pool open across scans. It is not thread-safe; use one Scanner per thread.
+"""
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import collections
+import csv
+import functools
 import hashlib
+import itertools
+import json
+import operator
+import os
+import posixpath
 import re
+import signal
+import socket
+import socketserver
 import sqlite3
+import stat
 import sys
+import threading
+import time
+
+import archive
+import bloom
+import db
+import hashcache
+import minhash
+import normalize
+import walk
+import winnow
+
+
+re_cc_filename = re.compile(r'.*\.(c|cc|cpp|cxx|h|hh|hpp|hxx)$', re.I)
+
+# Files are hashed in chunks of this size. Unbuffered reads of 1 MiB chunks
+# are faster than hashlib.file_digest(), which fills a 256 KiB bytearray for
+# every file, even a small one.
+CHUNK_SIZE = 1 << 20
+
+# Number of hashes resolved per query. Stays below the historic
+# SQLITE_MAX_VARIABLE_NUMBER limit of 999.
+BATCH_SIZE = 500
+
+# Fallback lookups for files whose exact hash wasn't found, cheapest first:
+# (match, normalization, column of the normalized table)
+NORMALIZATIONS = [
+    ("whitespace", normalize.normalize_whitespace, "whitespace_sha256"),
+    ("normalized", normalize.normalize, "normalized_sha256"),
+]
+
+# --amalgamations: files of at least AMALGAMATION_SIZE bytes whose exact hash
+# is unknown are searched for the fingerprints of indexed files. An indexed
+# file with at least MIN_FINGERPRINTS fingerprints is reported if at least
+# AMALGAMATION_COVERAGE of them are found. Files lose some fingerprints at
+# the seams, small files up to half of them.
+AMALGAMATION_SIZE = 64 * 1024
+AMALGAMATION_COVERAGE = 0.5
+MIN_FINGERPRINTS = 4
+
+
+# Types
+def intern(text):
+    """sys.intern() for nullable columns (all of them in schema v1)."""
+    return text if text is None else sys.intern(text)
+
+
+class FileRow:
+    """A row of the files table. The strings are interned: the findings of a
+    big scan reference far fewer distinct libraries, commits and paths than
+    there are findings."""
+    __slots__ = ("sha256", "library", "commit_hash", "commit_time",
+                 "commit_desc", "path", "size")
+
+    def __init__(self, sha256, library, commit_hash, commit_time,
+                 commit_desc, path, size):
+        self.sha256 = sha256
+        self.library = intern(library)
+        self.commit_hash = intern(commit_hash)
+        self.commit_time = intern(commit_time)
+        self.commit_desc = intern(commit_desc)
+        self.path = intern(path)
+        self.size = size
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+FILE_COLUMNS = ", ".join(FileRow.__slots__)
 
 
-parser = argparse.ArgumentParser(
-        prog="identify.py",
-        description="Identify embedded open-source libraries")
-parser.add_argument('-d',
-                    help="database path. Default: ./idlib.sqlite",
-                    default="idlib.sqlite", dest='db')
-parser.add_argument("-s", "--summarize", action="store_true", dest="summarize",
-                    help="don't report individual files, just the detected "
-                    "libs and their most probable version respectively.")
-# parser.add_argument("--list-libraries", action="store_true",
-#                     help="list all known libraries")
-parser.add_argument("directory",
-                    help="directory containing the source code to search")
-args = parser.parse_args()
-directory = Path(args.directory)
+def file_row_factory(cursor, row):
+    return FileRow(*row)
+
+
+class Finding:
+    """A database row matching a scanned file.
+
+    match: "exact", the normalization that made the file match, "similar"
+    with the estimated similarity (0..1) to the indexed file, or
+    "amalgamation" with the fraction of the indexed file's fingerprints
+    found."""
+    __slots__ = ("rel_path", "row", "match", "similarity")
+
+    def __init__(self, rel_path, row, match="exact", similarity=None):
+        self.rel_path = rel_path
+        self.row = row
+        self.match = match
+        self.similarity = similarity
+
+
+# Releases consistent with the findings of a library. partial: no single
+# release contains all of them, these are the ones containing the most.
+Releases = collections.namedtuple('Releases', ['tags', 'partial'])
+
+
+@functools.cache
+def row_class(fields):
+    return collections.namedtuple("Row", fields)
 
 
 def namedtuple_factory(cursor, row):
     """Returns sqlite rows as named tuples."""
-    fields = [col[0] for col in cursor.description]
-    Row = collections.namedtuple("Row", fields)
-    return Row(*row)
+    fields = tuple(col[0] for col in cursor.description)
+    return row_class(fields)(*row)
 
 
-con = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
-con.row_factory = namedtuple_factory
-cur = con.cursor()
+def file_sha256(path, stats):
+    """(path, sha256) of a file on disk. sha256 is the OSError instead if
+    the file can't be read, for example because it vanished since the
+    walk."""
+    t = stats.clock()
+    try:
+        # unbuffered: the chunks are read straight into their bytes objects
+        with open(path, "rb", buffering=0) as f:
+            stats.lap("read", t)
+            return path, fileobj_sha256(f, stats)
+    except OSError as e:
+        return path, e
 
 
-def identify(path):
-    blob = open(path, "rb").read()
+def fileobj_sha256(fileobj, stats):
+    """SHA-256 of a file object, read in chunks of CHUNK_SIZE, so memory use
+    doesn't depend on the file size."""
     m = hashlib.sha256()
-    m.update(blob)
-    sha256 = m.hexdigest()
-    rows = cur.execute("SELECT * FROM files WHERE sha256 = ?", (sha256,))
-    return rows
+    size = 0
+    while True:
+        t = stats.clock()
+        chunk = fileobj.read(CHUNK_SIZE)
+        t = stats.lap("read", t)
+        if not chunk:
+            break
+        m.update(chunk)
+        stats.lap("hash", t)
+        size += len(chunk)
+    stats.count_hashed(size)
+    return m.digest()
 
 
-Finding = collections.namedtuple('Finding', ['rel_path', 'row'])
-lib_findings = {}
+def cached_file_sha256(item, stats):
+    path, st, sha256 = item
+    if sha256 is None:
+        _, sha256 = file_sha256(path, stats)
+        return path, st, sha256, False
+    return path, st, sha256, True
 
-re_cc_filename = re.compile(r'.*\.(c|cc|cpp|cxx|h|hh|hpp|hxx)$', re.I)
-for path in directory.glob('**/*'):
-    rel_path = path.relative_to(directory)
-    if re_cc_filename.match(path.name) and path.is_file():
-        rows = identify(path)
+
+def batched(iterable, n):
+    """Batches of n items. Same as itertools.batched() in Python 3.12."""
+    it = iter(iterable)
+    while batch := tuple(itertools.islice(it, n)):
+        yield batch
+
+
+def bounded_map(executor, fn, iterable, window):
+    """Like executor.map(), but with at most `window` pending futures.
+
+    Results are yielded in input order, so the output is deterministic and
+    memory stays bounded regardless of the size of `iterable`."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def package_name(path):
+    """Name of a scanned directory or archive, without archive suffixes."""
+    name = Path(path).resolve().name
+    lname = name.lower()
+    for suffix in ('.src.rpm',) + archive.ARCHIVE_SUFFIXES:
+        if lname.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+_END = object()  # end of iteration, see Stats.timed()
+
+
+class Stats:
+    """Counters and per-phase timings of a Scanner, see --stats.
+
+    Phases: walk (directory and archive traversal), read, hash (including
+    normalization, signatures and fingerprints of fallback lookups), lookup
+    (database queries) and report (writing the output). Times of read and
+    hash are summed over the hashing threads. Timing costs a few
+    microseconds per file, so it is off unless `timings` is set; the
+    counters are always kept. Thread-safe."""
+
+    PHASES = ("walk", "read", "hash", "lookup", "report")
+    COUNTERS = ("sources", "files_walked", "files_filtered", "files_hashed",
+                "bytes_hashed", "cache_hits", "files_scanned", "files_matched",
+                "fallback_files", "findings", "hashes_looked_up",
+                "prefiltered", "db_queries")
+
+    def __init__(self, timings=False):
+        self.timings = timings
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.wall = dict.fromkeys(self.PHASES, 0.0)
+        self.cpu = dict.fromkeys(self.PHASES, 0.0)
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.threads = 1
+
+    def clock(self):
+        if not self.timings:
+            return None
+        return time.perf_counter(), time.thread_time()
+
+    def lap(self, phase, since):
+        """Adds the time since `since` (a clock()) to a phase, returns the
+        current clock()."""
+        if since is None:
+            return None
+        now = self.clock()
+        with self.lock:
+            self.wall[phase] += now[0] - since[0]
+            self.cpu[phase] += now[1] - since[1]
+        return now
+
+    def timed(self, phase, iterable):
+        """Iterates over iterable, adding the time spent in it to a
+        phase."""
+        if not self.timings:
+            return iterable
+        return self._timed(phase, iterable)
+
+    def _timed(self, phase, iterable):
+        it = iter(iterable)
+        while True:
+            t = self.clock()
+            item = next(it, _END)
+            self.lap(phase, t)
+            if item is _END:
+                return
+            yield item
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def count_hashed(self, size):
+        with self.lock:
+            self.counters["files_hashed"] += 1
+            self.counters["bytes_hashed"] += size
+
+    def hit_ratio(self):
+        """Fraction of the scanned files whose exact hash was found."""
+        scanned = self.counters["files_scanned"]
+        return self.counters["files_matched"] / scanned if scanned else 0
+
+    def as_dict(self):
+        """All statistics, as written by --stats json."""
+        with self.lock:
+            result = dict(self.counters)
+            result["hit_ratio"] = round(self.hit_ratio(), 4)
+            result["wall_time"] = round(time.perf_counter() - self.start, 6)
+            result["cpu_time"] = round(time.process_time() - self.start_cpu,
+                                       6)
+            result["hashing_threads"] = self.threads
+            if self.timings:
+                result["phases"] = {
+                        phase: {"wall": round(self.wall[phase], 6),
+                                "cpu": round(self.cpu[phase], 6)}
+                        for phase in self.PHASES}
+        return result
+
+
+def format_stats(stats):
+    """Human-readable form of Stats.as_dict()."""
+    lines = [
+        f"sources             {stats['sources']:12d}",
+        f"files walked        {stats['files_walked']:12d}",
+        f"files filtered      {stats['files_filtered']:12d}",
+        f"files hashed        {stats['files_hashed']:12d}"
+        f"  ({stats['bytes_hashed'] / 1e6:.1f} MB)",
+        f"cache hits          {stats['cache_hits']:12d}",
+        f"files scanned       {stats['files_scanned']:12d}",
+        f"files matched       {stats['files_matched']:12d}"
+        f"  (hit ratio {stats['hit_ratio']:.1%})",
+        f"fallback lookups    {stats['fallback_files']:12d}",
+        f"findings            {stats['findings']:12d}",
+        f"hashes looked up    {stats['hashes_looked_up']:12d}"
+        f"  ({stats['prefiltered']} skipped by the prefilter)",
+        f"database queries    {stats['db_queries']:12d}",
+        "",
+        "phase                   wall s       cpu s",
+    ]
+    for phase, times in stats.get("phases", {}).items():
+        lines.append(f"{phase:16s}  {times['wall']:10.3f}  "
+                     f"{times['cpu']:10.3f}")
+    lines.append(f"{'total':16s}  {stats['wall_time']:10.3f}  "
+                 f"{stats['cpu_time']:10.3f}")
+    if "phases" in stats and stats["hashing_threads"] > 1:
+        lines.append(f"(read and hash summed over {stats['hashing_threads']} "
+                     "hashing threads)")
+    return "\n".join(lines)
+
+
+class Scanner:
+    """Looks up files and hashes in an idlib database.
+
+    prefilter: True uses DB.bloom if it exists, a path uses that Bloom
+               filter, False disables it.
+    file_filter: "size" (default), "name" or "none", see --filter.
+    cache: path of a persistent hash cache, or None.
+    normalized: None, "whitespace" or "full", see --normalized.
+    similarity: None, or the minimum similarity for --similarity.
+    amalgamation_size: None, or the minimum size of the files searched for
+                       fingerprints, see --amalgamations.
+    max_size: None, or the size of the largest file to read, see --max-size.
+    timings: collect per-phase timings in `stats`, see --stats.
+    """
+
+    def __init__(self, db_path, jobs=1, prefilter=True, file_filter="size",
+                 exclude_dirs=walk.DEFAULT_PRUNE, follow_symlinks=False,
+                 cache=None, cache_size=1_000_000, normalized=None,
+                 similarity=None, amalgamation_size=None, max_size=None,
+                 timings=False):
+        self.stats = Stats(timings)
+        self.db_path = db_path
+        self.con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        self.con.row_factory = namedtuple_factory
+        self.cur = self.con.cursor()
+        self.files_cur = self.con.cursor()
+        self.files_cur.row_factory = file_row_factory
+
+        # Schema v1 stores hex strings, later versions store the raw digest.
+        db_version = db.schema_version(self.con)
+        if db_version == 0 or db_version > db.SCHEMA_VERSION:
+            self.con.close()
+            raise ValueError(f"unsupported schema version {db_version}")
+        self.sha256_key = bytes.hex if db_version == 1 else bytes
+
+        self.prefilter = None
+        if prefilter is True:
+            path = f"{db_path}.bloom"
+            if os.path.exists(path):
+                self.prefilter = self._load_prefilter(path)
+        elif prefilter:
+            self.prefilter = self._load_prefilter(prefilter)
+
+        if file_filter not in ("size", "name", "none"):
+            raise ValueError(f"unknown file filter: {file_filter}")
+        self.file_filter = file_filter
+        self.indexed_names = None
+        self.indexed_sizes = None
+        if file_filter == "name":
+            self.indexed_names = self._load_names()
+        elif file_filter == "size":
+            self.indexed_sizes = self._load_sizes()
+        self.max_indexed_size = None
+        if file_filter == "none":
+            # larger files can't match exactly
+            self.max_indexed_size = self._max_indexed_size()
+        self.max_size = max_size
+
+        # Fallback lookups (normalized hashes, similarity) are limited to
+        # files with an indexed basename. Modified copies differ in size, so
+        # they bypass the file filter.
+        self.normalizations = []
+        if normalized not in (None, "whitespace", "full"):
+            raise ValueError(f"unknown normalization: {normalized}")
+        if normalized and not db.table_exists(self.con, "normalized"):
+            self.warn(f"ignoring --normalized: {db_path} has no normalized "
+                      "hashes")
+        elif normalized:
+            self.normalizations = NORMALIZATIONS[:1 if normalized ==
+                                                 "whitespace" else 2]
+        self.min_similarity = None
+        if similarity is not None and not 0 < similarity <= 1:
+            raise ValueError(f"similarity must be in (0, 1]: {similarity}")
+        if similarity is not None and not db.table_exists(self.con, "lsh"):
+            self.warn(f"ignoring --similarity: {db_path} has no MinHash "
+                      "signatures")
+        elif similarity is not None:
+            self.min_similarity = similarity
+        self.fallback_names = None
+        if self.normalizations or self.min_similarity is not None:
+            self.fallback_names = {name for name, _ in self._load_names()}
+        # Amalgamations are large and have no indexed name or size.
+        self.amalgamation_size = None
+        if amalgamation_size is not None and not db.table_exists(
+                self.con, "fingerprints"):
+            self.warn(f"ignoring --amalgamations: {db_path} has no "
+                      "fingerprints")
+        elif amalgamation_size is not None:
+            self.amalgamation_size = amalgamation_size
+
+        self.has_releases = db.table_exists(self.con, "containment")
+        self.release_tags_cache = {}
+        self.exclude_dirs = exclude_dirs
+        self.follow_symlinks = follow_symlinks
+
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.stats.threads = self.jobs
+        self.executor = None
+        if self.jobs > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.hash_cache = None
+        if cache:
+            self.hash_cache = hashcache.HashCache(cache,
+                                                  max_entries=cache_size)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.hash_cache is not None:
+            self.hash_cache.close()
+            self.hash_cache = None
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def warn(self, message):
+        print(f"warning: {message}", file=sys.stderr)
+
+    def _load_prefilter(self, path):
+        try:
+            bf = bloom.BloomFilter.load(path)
+        except (OSError, ValueError) as e:
+            self.warn(f"ignoring prefilter: {e}")
+            return None
+        # A filter of another generation of the database, for example the
+        # previous release, would silently drop the matches added since.
+        generation = db.generation(self.con)
+        if generation is None or bf.generation != generation:
+            self.warn(f"ignoring prefilter {path}: it doesn't match "
+                      f"{self.db_path}")
+            return None
+        return bf
+
+    def _load_names(self):
+        """Returns the set of indexed (basename, size) pairs."""
+        if db.table_exists(self.con, "names"):
+            return set(self.con.execute("SELECT name, size FROM names"))
+        # older database, derive the names from the files table
+        return {(posixpath.basename(path), size) for path, size in
+                self.con.execute("SELECT DISTINCT path, size FROM files")}
+
+    def _load_sizes(self):
+        """Returns the set of indexed file sizes."""
+        table = "names" if db.table_exists(self.con, "names") else "files"
+        return {size for (size,) in
+                self.con.execute(f"SELECT DISTINCT size FROM {table}")}
+
+    def _max_indexed_size(self):
+        table = "names" if db.table_exists(self.con, "names") else "files"
+        return self.con.execute(f"SELECT MAX(size) AS size FROM {table}"
+                                ).fetchone()[0] or 0
+
+    def wanted(self, name, size):
+        """True if a file could match an indexed file."""
+        if not re_cc_filename.match(name):
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.fallback_candidate(name, size):
+            return True
+        if self.file_filter == "size":
+            return size in self.indexed_sizes
+        if self.file_filter == "name":
+            return (name, size) in self.indexed_names
+        return size <= self.max_indexed_size
+
+    # Lookups
+    def _query(self, sql, params=(), cur=None):
+        """All rows of a query, counted and timed in the stats. cur: a cursor
+        with a different row factory."""
+        t = self.stats.clock()
+        rows = (cur or self.cur).execute(sql, params).fetchall()
+        self.stats.lap("lookup", t)
+        self.stats.count("db_queries")
+        return rows
+
+    def lookup_batch(self, sha256s):
+        """Looks up many hashes (raw digests) with a single query.
+
+        Returns {sha256_key(digest): [row, ...]} for all hashes found.
+        The prefilter drops the digests that are certainly not indexed.
+        Full batches produce the same SQL text, so sqlite3 reuses the prepared
+        statement from its statement cache."""
+        result = {}
+        sha256s = list(sha256s)
+        self.stats.count("hashes_looked_up", len(sha256s))
+        if self.prefilter is not None:
+            num_hashes = len(sha256s)
+            sha256s = self.prefilter.filter(sha256s)
+            self.stats.count("prefiltered", num_hashes - len(sha256s))
+            if not sha256s:
+                return result
+        placeholders = ",".join("?" * len(sha256s))
+        rows = self._query(
+                f"SELECT {FILE_COLUMNS} FROM files "
+                f"WHERE sha256 IN ({placeholders})",
+                [self.sha256_key(sha256) for sha256 in sha256s],
+                self.files_cur)
         for row in rows:
-            if row.library not in lib_findings:
-                lib_findings[row.library] = []
-            f = Finding(rel_path, row)
-            lib_findings[row.library].append(f)
-
-if args.summarize:
-    # For each library, sort all matches by the commit time and print only the
-    # latest file description.
-    for lib_name, findings in sorted(lib_findings.items()):
-        latest = sorted(findings, key=lambda f: f.row.commit_time)[-1]
-        print(lib_name, latest.row.commit_desc)
-else:
-    for lib_name, findings in sorted(lib_findings.items()):
-        for f in findings:
-            print(f"{f.row.library:10s}  {f.row.commit_desc:30s}  {f.rel_path}")
-        sys.stdout.flush()
+            result.setdefault(row.sha256, []).append(row)
+        return result
+
+    def lookup(self, sha256s):
+        """Yields (sha256, row) for all database rows matching the given
+        digests (raw bytes), for example computed by another process."""
+        for batch in batched(sha256s, BATCH_SIZE):
+            matches = self.lookup_batch(batch)
+            for sha256 in batch:
+                for row in matches.get(self.sha256_key(sha256), ()):
+                    yield sha256, row
+
+    def lookup_normalized(self, column, keys):
+        """Looks up the normalized hashes of up to BATCH_SIZE files.
+
+        Returns {key: [row, ...]} with the files rows of all indexed files
+        whose normalized hash (column of the normalized table) is a key."""
+        placeholders = ",".join("?" * len(keys))
+        pairs = self._query(
+                f"SELECT {column} AS key, sha256 FROM normalized "
+                f"WHERE {column} IN ({placeholders})", keys)
+        rows = {}
+        for sha256, row in self.lookup({pair.sha256 for pair in pairs}):
+            rows.setdefault(sha256, []).append(row)
+        result = {}
+        for key, sha256 in pairs:
+            result.setdefault(key, []).extend(rows.get(sha256, ()))
+        return result
+
+    def lookup_similar(self, signature):
+        """Returns (similarity, [sha256, ...]) of the most similar indexed
+        files, found by their LSH bands, or None if there are none."""
+        conditions = " OR ".join(["(band = ? AND key = ?)"] * minhash.BANDS)
+        params = [value for band in minhash.bands(signature)
+                  for value in band]
+        best = None
+        best_sha256s = []
+        for sha256, candidate in self._query(
+                f"SELECT DISTINCT minhash.sha256, minhash.signature "
+                f"FROM lsh JOIN minhash USING (sha256) WHERE {conditions}",
+                params):
+            score = minhash.similarity(signature, candidate)
+            if best is None or score > best:
+                best = score
+                best_sha256s = [sha256]
+            elif score == best:
+                best_sha256s.append(sha256)
+        if best is None:
+            return None
+        return best, best_sha256s
+
+    def lookup_fingerprints(self, hashes):
+        """Returns {sha256: coverage} of the indexed files with at least
+        AMALGAMATION_COVERAGE of their fingerprints in hashes."""
+        hits = collections.Counter()
+        for batch in batched(hashes, BATCH_SIZE):
+            placeholders = ",".join("?" * len(batch))
+            hits.update(sha256 for (sha256,) in self._query(
+                    f"SELECT sha256 FROM fingerprints "
+                    f"WHERE hash IN ({placeholders})", batch))
+        # prune before looking up the fingerprint counts: noise (common
+        # token sequences) hits many files with few fingerprints each
+        candidates = [sha256 for sha256, n in hits.items()
+                      if n >= MIN_FINGERPRINTS * AMALGAMATION_COVERAGE]
+        result = {}
+        for batch in batched(candidates, BATCH_SIZE):
+            placeholders = ",".join("?" * len(batch))
+            for sha256, total in self._query(
+                    f"SELECT sha256, fingerprints FROM fingerprinted "
+                    f"WHERE sha256 IN ({placeholders})", batch):
+                # rounded like in record(), so clients print the same
+                coverage = round(hits[sha256] / total, 3)
+                if (total >= MIN_FINGERPRINTS and
+                        coverage >= AMALGAMATION_COVERAGE):
+                    result[sha256] = coverage
+        return result
+
+    # Hashing
+    def _ordered_map(self, fn, items):
+        """map() in the thread pool, if any."""
+        if self.executor is None:
+            return map(fn, items)
+        return bounded_map(self.executor, fn, items, window=4 * self.jobs)
+
+    def hashed_files(self, files):
+        """Yields (path, sha256) for all (path, stat) in files. Files that
+        can't be read are skipped with a warning."""
+        if self.hash_cache is None:
+            for path, sha256 in self._ordered_map(
+                    functools.partial(file_sha256, stats=self.stats),
+                    (path for path, _ in files)):
+                if isinstance(sha256, OSError):
+                    self.warn(f"skipping {path}: {sha256.strerror}")
+                    continue
+                yield path, sha256
+            return
+        # cache lookups and updates happen in this thread, only misses are
+        # hashed
+        hash_cache = self.hash_cache
+        lookups = ((path, st, hash_cache.get(path, st)) for path, st in files)
+        for path, st, sha256, hit in self._ordered_map(
+                functools.partial(cached_file_sha256, stats=self.stats),
+                lookups):
+            if isinstance(sha256, OSError):
+                self.warn(f"skipping {path}: {sha256.strerror}")
+                continue
+            if hit:
+                self.stats.count("cache_hits")
+            else:
+                hash_cache.put(path, st, sha256)
+            yield path, sha256
+
+    def source_files(self, directory):
+        """Yields (path, stat) of all files that could match an indexed
+        file."""
+        files = walk.files(directory, re_cc_filename.match,
+                           prune=self.exclude_dirs,
+                           follow_symlinks=self.follow_symlinks)
+        for path, st in self.stats.timed("walk", files):
+            self.stats.count("files_walked")
+            if self.wanted(os.path.basename(path), st.st_size):
+                yield path, st
+            else:
+                self.stats.count("files_filtered")
+
+    def fallback_candidate(self, path, size):
+        """True if a file gets fallback lookups (normalized hashes,
+        similarity, fingerprints) if its exact hash is unknown."""
+        if (self.fallback_names is not None and
+                os.path.basename(path) in self.fallback_names):
+            return True
+        return self.amalgamation_candidate(size)
+
+    def amalgamation_candidate(self, size):
+        return (self.amalgamation_size is not None and
+                size >= self.amalgamation_size)
+
+    def read_fallback_candidate(self, path):
+        """Contents of a file on disk if it is a fallback candidate, else
+        None."""
+        if self.fallback_names is None and self.amalgamation_size is None:
+            return None
+        try:
+            if not self.fallback_candidate(path, os.stat(path).st_size):
+                return None
+            t = self.stats.clock()
+            data = path.read_bytes()
+            self.stats.lap("read", t)
+            return data
+        except OSError:
+            return None  # vanished since it was hashed
+
+    def hashed_archive_members(self, path):
+        """Yields (member path, sha256, data) of all C/C++ files in an
+        archive. data is only kept for candidates of fallback lookups,
+        otherwise it is None."""
+        stats = self.stats
+        # archive.members() calls wanted() right before yielding the member
+        member_size = 0
+
+        def on_error(member, e):
+            self.warn(f"{path}: skipping {member}: {e}")
+
+        def wanted(name, size):
+            nonlocal member_size
+            if not re_cc_filename.match(name):
+                return False
+            stats.count("files_walked")
+            if self.wanted(name, size):
+                member_size = size
+                return True
+            stats.count("files_filtered")
+            return False
+
+        with open(path, "rb") as f:
+            members = archive.members(f, path.name, wanted, on_error,
+                                      self.exclude_dirs)
+            for name, member in stats.timed("walk", members):
+                if not self.fallback_candidate(name, member_size):
+                    yield name, fileobj_sha256(member, stats), None
+                    continue
+                t = stats.clock()
+                data = member.read()
+                t = stats.lap("read", t)
+                sha256 = hashlib.sha256(data).digest()
+                stats.lap("hash", t)
+                stats.count_hashed(len(data))
+                yield name, sha256, data
+
+    def hashed_sources(self, directory):
+        """Yields (relative path, sha256, data) of all C/C++ files in a
+        directory or archive. data is None for files on disk."""
+        if directory.is_file() and archive.is_archive(directory.name):
+            yield from self.hashed_archive_members(directory)
+            return
+        for path, sha256 in self.hashed_files(self.source_files(directory)):
+            yield os.path.relpath(path, directory), sha256, None
+
+    # Scanning
+    def scan(self, source):
+        """Yields a Finding for every database row matching a file in a
+        directory or archive."""
+        source = Path(source)
+        if not source.exists():
+            raise FileNotFoundError("no such file or directory")
+        stats = self.stats
+        stats.count("sources")
+        if self.hash_cache is not None:
+            self.hash_cache.begin()
+        on_disk = source.is_dir()
+        for batch in batched(self.hashed_sources(source), BATCH_SIZE):
+            stats.count("files_scanned", len(batch))
+            matches = self.lookup_batch(sha256 for _, sha256, _ in batch)
+            missed = []
+            for rel_path, sha256, data in batch:
+                rows = matches.get(self.sha256_key(sha256))
+                if rows:
+                    stats.count("files_matched")
+                    stats.count("findings", len(rows))
+                    for row in rows:
+                        yield Finding(rel_path, row)
+                else:
+                    if data is None and on_disk:
+                        data = self.read_fallback_candidate(source / rel_path)
+                    if data is not None:
+                        missed.append((rel_path, data))
+            stats.count("fallback_files", len(missed))
+            for finding in self.scan_missed(missed):
+                stats.count("findings")
+                yield finding
+
+    def scan_missed(self, missed):
+        """Findings for (rel_path, data) of files whose exact hash wasn't
+        found. Each normalization only runs on the files the previous,
+        cheaper one couldn't match, similarity lookups only on the rest.
+        Large files without any match are searched for fingerprints."""
+        unmatched = []
+        if self.fallback_names is not None:
+            named = []
+            for rel_path, data in missed:
+                if os.path.basename(rel_path) in self.fallback_names:
+                    named.append((rel_path, data))
+                else:
+                    unmatched.append((rel_path, data))
+            missed = named
+        for match, normalization, column in self.normalizations:
+            if not missed:
+                break
+            t = self.stats.clock()
+            keys = [hashlib.sha256(normalization(data)).digest()
+                    for _, data in missed]
+            self.stats.lap("hash", t)
+            matches = self.lookup_normalized(column, keys)
+            remaining = []
+            for (rel_path, data), key in zip(missed, keys):
+                rows = matches.get(key)
+                if rows:
+                    for row in rows:
+                        yield Finding(rel_path, row, match)
+                else:
+                    remaining.append((rel_path, data))
+            missed = remaining
+        for rel_path, data in missed:
+            if self.min_similarity is None:
+                unmatched.append((rel_path, data))
+                continue
+            t = self.stats.clock()
+            signature = minhash.signature(data)
+            self.stats.lap("hash", t)
+            similar = None
+            if signature is not None:
+                similar = self.lookup_similar(signature)
+            if similar is None or similar[0] < self.min_similarity:
+                unmatched.append((rel_path, data))
+                continue
+            score, sha256s = similar
+            for _, row in self.lookup(sha256s):
+                yield Finding(rel_path, row, "similar", score)
+        for rel_path, data in unmatched:
+            if self.amalgamation_candidate(len(data)):
+                yield from self.scan_amalgamation(rel_path, data)
+
+    def scan_amalgamation(self, rel_path, data):
+        """Findings for the indexed files contained in a large file. Of the
+        versions of an indexed file, only the best covered are reported."""
+        t = self.stats.clock()
+        fingerprints = winnow.fingerprints(data)
+        self.stats.lap("hash", t)
+        coverage = self.lookup_fingerprints(fingerprints)
+        best = {}  # (library, path) -> (coverage, [row, ...])
+        for sha256, row in self.lookup(coverage):
+            key = (row.library, row.path)
+            score = coverage[sha256]
+            if key not in best or score > best[key][0]:
+                best[key] = (score, [row])
+            elif score == best[key][0]:
+                best[key][1].append(row)
+        for key in sorted(best):
+            score, rows = best[key]
+            for row in rows:
+                yield Finding(rel_path, row, "amalgamation", score)
+
+    def scan_libraries(self, source):
+        """Returns {library: [Finding, ...]} for a directory or archive."""
+        lib_findings = {}
+        for f in self.scan(source):
+            if f.row.library not in lib_findings:
+                lib_findings[f.row.library] = []
+            lib_findings[f.row.library].append(f)
+        return lib_findings
+
+    def release_tags(self, library):
+        if library not in self.release_tags_cache:
+            rows = self._query("SELECT tag FROM releases "
+                               "WHERE library = ? ORDER BY id", (library,))
+            self.release_tags_cache[library] = [tag for (tag,) in rows]
+        return self.release_tags_cache[library]
+
+    def consistent_releases(self, library, sha256s):
+        """Intersects the release bitmaps of a library's matched hashes."""
+        if not self.has_releases:
+            return None
+        tags = self.release_tags(library)
+        if not tags:
+            return None
+        bits = dict.fromkeys(sha256s, 0)
+        for batch in batched(bits, BATCH_SIZE):
+            placeholders = ",".join("?" * len(batch))
+            for row in self._query(
+                    f"SELECT sha256, releases FROM containment "
+                    f"WHERE library = ? AND sha256 IN ({placeholders})",
+                    (library, *batch)):
+                bits[row.sha256] = int.from_bytes(row.releases, 'little')
+        bitmaps = list(bits.values())
+        consistent = functools.reduce(operator.and_, bitmaps)
+        if consistent:
+            return Releases([tag for i, tag in enumerate(tags)
+                             if consistent >> i & 1], False)
+        # mixed copy: report the releases that contain the most files
+        counts = [sum(bits >> i & 1 for bits in bitmaps)
+                  for i in range(len(tags))]
+        best = max(counts)
+        return Releases([tag for i, tag in enumerate(tags)
+                         if best and counts[i] == best], True)
+
+    def results(self, lib_findings):
+        """Yields (library, commit_desc, path, releases, match, similarity,
+        indexed_path) in output order. indexed_path is the path of the
+        indexed file found in an amalgamation, None for other matches.
+        releases is always None, see stream() for the summaries."""
+        for lib_name, findings in sorted(lib_findings.items()):
+            for f in findings:
+                yield (f.row.library, f.row.commit_desc, f.rel_path, None,
+                       f.match, f.similarity, indexed_path(f))
+
+    def scan_results(self, source, summarize):
+        """results() for a directory or archive. In summarize mode, the
+        summaries of stream(), which keeps a running summary per library
+        rather than every finding."""
+        if summarize:
+            return self.stream(source, True)
+        return self.results(self.scan_libraries(source))
+
+    def stream(self, source, summarize):
+        """Like results(), but yields each match as soon as it is found,
+        followed by the summary of each library (path None).
+
+        Only the summaries are kept in memory, so the memory use doesn't
+        grow with the number of matches. In summarize mode, only the
+        summaries are yielded."""
+        summaries = {}
+        for f in self.scan(source):
+            library = f.row.library
+            if library not in summaries:
+                summaries[library] = Summary()
+            summaries[library].add(f)
+            if not summarize:
+                yield (library, f.row.commit_desc, f.rel_path, None, f.match,
+                       f.similarity, indexed_path(f))
+        for library, summary in sorted(summaries.items()):
+            yield (library, summary.latest.commit_desc, None,
+                   self.consistent_releases(library, summary.sha256s), None,
+                   None, None)
+
+
+def indexed_path(finding):
+    if finding.match == "amalgamation":
+        return finding.row.path
+    return None
+
+
+class Summary:
+    """Running summary of the matches of one library: the latest matched
+    row (by commit time) and the distinct matched hashes."""
+
+    def __init__(self):
+        self.latest = None
+        self.sha256s = set()
+
+    def add(self, finding):
+        row = finding.row
+        # on ties the later match wins
+        if self.latest is None or row.commit_time >= self.latest.commit_time:
+            self.latest = row
+        self.sha256s.add(row.sha256)
+
+
+# Output
+def record(package, library, version, path, releases, match=None,
+           similarity=None, indexed_path=None):
+    """A result as JSON object, used by -f json and the server."""
+    result = {"package": package, "library": library, "version": version}
+    if path is not None:
+        result["path"] = str(path)
+    if match not in (None, "exact"):
+        result["match"] = match
+    if similarity is not None:
+        result["similarity"] = round(similarity, 3)
+    if indexed_path is not None:
+        result["indexed_path"] = indexed_path
+    if releases is not None:
+        result["releases"] = releases.tags
+        result["partial"] = releases.partial
+    return result
+
+
+class TextWriter:
+    def __init__(self, batch):
+        self.batch = batch  # prefix each line with the package name
+
+    def write(self, package, library, version, path, releases, match=None,
+              similarity=None, indexed_path=None):
+        prefix = f"{package}  " if self.batch else ""
+        if path is None:
+            line = f"{prefix}{library} {version}"
+            if releases is not None:
+                partial = "partial: " if releases.partial else ""
+                line += f" ({partial}{', '.join(releases.tags)})"
+            print(line)
+        elif indexed_path is not None:
+            print(f"{prefix}{library:10s}  {version:30s}  {path}  "
+                  f"({match} {similarity:.2f}: {indexed_path})")
+        elif similarity is not None:
+            print(f"{prefix}{library:10s}  {version:30s}  {path}  "
+                  f"({match} {similarity:.2f})")
+        elif match not in (None, "exact"):
+            print(f"{prefix}{library:10s}  {version:30s}  {path}  ({match})")
+        else:
+            print(f"{prefix}{library:10s}  {version:30s}  {path}")
+
+    def close(self):
+        pass
+
+
+class CSVWriter:
+    def __init__(self, summarize, match_column=False):
+        self.writer = csv.writer(sys.stdout)
+        self.match_column = match_column and not summarize
+        fields = ["package", "library", "version"]
+        if summarize:
+            fields += ["releases", "partial"]
+        else:
+            fields.append("path")
+        if self.match_column:
+            fields += ["match", "similarity", "indexed_path"]
+        self.writer.writerow(fields)
+
+    def write(self, package, library, version, path, releases, match=None,
+              similarity=None, indexed_path=None):
+        row = [package, library, version]
+        if path is not None:
+            row.append(str(path))
+            if self.match_column:
+                row += [match or "exact",
+                        "" if similarity is None else f"{similarity:.3f}",
+                        indexed_path or ""]
+        elif releases is not None:
+            row += [" ".join(releases.tags), int(releases.partial)]
+        else:
+            row += ["", ""]
+        self.writer.writerow(row)
+
+    def close(self):
+        pass
+
+
+class JSONLinesWriter:
+    """One JSON object per line, written as soon as it is known. Matches
+    have "type": "match", the per-library summaries "type": "summary"."""
+
+    def write(self, package, library, version, path, releases, match=None,
+              similarity=None, indexed_path=None):
+        result = {"type": "match" if path is not None else "summary"}
+        result.update(record(package, library, version, path, releases,
+                             match, similarity, indexed_path))
+        print(json.dumps(result), flush=True)
+
+    def close(self):
+        pass
+
+
+class JSONWriter:
+    def __init__(self):
+        self.records = []
+
+    def write(self, package, library, version, path, releases, match=None,
+              similarity=None, indexed_path=None):
+        self.records.append(record(package, library, version, path,
+                                   releases, match, similarity, indexed_path))
+
+    def close(self):
+        json.dump(self.records, sys.stdout, indent=2)
+        print()
+
+
+# Client mode: let a server started with --serve do the work.
+def write_result(writer, r):
+    releases = None
+    if "releases" in r:
+        releases = Releases(r["releases"], r["partial"])
+    writer.write(r["package"], r["library"], r["version"], r.get("path"),
+                 releases, r.get("match"), r.get("similarity"),
+                 r.get("indexed_path"))
+
+
+def run_client(socket_path, sources, summarize, writer, stream=False,
+               stats=None):
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    except OSError as e:
+        print(f"error: {socket_path}: {e}", file=sys.stderr)
+        return 1
+    exit_code = 0
+    with sock, sock.makefile("rwb") as f:
+        for directory in sources:
+            request = {"scan": os.path.abspath(directory),
+                       "summarize": summarize, "stream": stream}
+            f.write(json.dumps(request).encode() + b"\n")
+            f.flush()
+            while True:
+                response = json.loads(f.readline() or
+                                      '{"error": "no response"}')
+                if "error" in response:
+                    print(f"error: {directory}: {response['error']}",
+                          file=sys.stderr)
+                    exit_code = 1
+                    break
+                if "result" in response:  # streamed
+                    write_result(writer, response["result"])
+                    continue
+                for r in response.get("results", ()):
+                    write_result(writer, r)
+                break
+            sys.stdout.flush()
+        if stats:
+            f.write(json.dumps({"stats": True}).encode() + b"\n")
+            f.flush()
+            response = json.loads(f.readline() or '{"error": "no response"}')
+            if "stats" in response:
+                print_stats(response["stats"], stats)
+            else:
+                print(f"error: {socket_path}: {response.get('error')}",
+                      file=sys.stderr)
+                exit_code = 1
+    writer.close()
+    return exit_code
+
+
+# Server mode: one request per line, one JSON response per line.
+#   {"scan": "/abs/path", "summarize": false} -> {"results": [record, ...]}
+#   {"lookup": ["<sha256 hex>", ...]}         -> {"matches": {hex: [row]}}
+#   {"stats": true}                           -> {"stats": {...}}
+# With "stream": true, a scan is answered with one {"result": record} line
+# per record as soon as it is found, terminated by {"results": []}.
+# Requests are handled one at a time, hashing still uses --jobs threads.
+def row_record(row):
+    return {k: v.hex() if isinstance(v, bytes) else v
+            for k, v in row._asdict().items()}
+
+
+def handle_request(scanner, request):
+    """Yields the response lines for a request."""
+    if "lookup" in request:
+        matches = {}
+        digests = [bytes.fromhex(h) for h in request["lookup"]]
+        for sha256, row in scanner.lookup(digests):
+            matches.setdefault(sha256.hex(), []).append(row_record(row))
+        yield {"matches": matches}
+    elif "scan" in request:
+        directory = Path(request["scan"])
+        package = package_name(directory)
+        summarize = request.get("summarize", False)
+        if request.get("stream", False):
+            for r in scanner.stream(directory, summarize):
+                yield {"result": record(package, *r)}
+            yield {"results": []}
+            return
+        yield {"results": [record(package, *r) for r in
+                           scanner.scan_results(directory, summarize)]}
+    elif "stats" in request:
+        # cumulative since the server started
+        yield {"stats": scanner.stats.as_dict()}
+    else:
+        raise ValueError("unknown request")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        scanner = self.server.scanner
+        for line in self.rfile:
+            try:
+                for response in handle_request(scanner, json.loads(line)):
+                    self.respond(response)
+            except ((ValueError, KeyError, TypeError) +
+                    archive.ARCHIVE_ERRORS) as e:
+                self.respond({"error": str(e)})
+            if scanner.hash_cache is not None:
+                scanner.hash_cache.flush()
+
+    def respond(self, response):
+        t = self.server.scanner.stats.clock()
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.wfile.flush()
+        self.server.scanner.stats.lap("report", t)
+
+
+def serve(scanner, socket_path):
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            print(f"error: {socket_path} exists and is not a socket",
+                  file=sys.stderr)
+            return 1
+        os.unlink(socket_path)  # stale socket of a previous server
+    # exit cleanly on SIGTERM, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socketserver.UnixStreamServer(socket_path, RequestHandler) as server:
+        server.scanner = scanner
+        print(f"listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+    return 0
+
+
+# CLI
+def print_stats(stats, stats_format):
+    """Writes Stats.as_dict() to stderr, so it doesn't mix with the
+    results."""
+    if stats_format == "json":
+        print(json.dumps(stats), file=sys.stderr)
+    else:
+        print(format_stats(stats), file=sys.stderr)
+
+
+def parse_size(text):
+    """Parses a size like 1048576, 64K, 100M or 2G."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    number, unit = text[:-1], text[-1:].upper()
+    try:
+        if unit in units:
+            return int(number) * units[unit]
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}") from None
+
+
+def read_sources(path):
+    f = sys.stdin if path == "-" else open(path)
+    with f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+            prog="identify.py",
+            description="Identify embedded open-source libraries")
+    parser.add_argument('-d',
+                        help="database path. Default: ./idlib.sqlite",
+                        default="idlib.sqlite", dest='db')
+    parser.add_argument("-s", "--summarize", action="store_true",
+                        dest="summarize",
+                        help="don't report individual files, just the "
+                        "detected libs and their most probable version "
+                        "respectively.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of parallel hashing threads. "
+                        "0 = number of CPUs. Default: 1")
+    parser.add_argument("--prefilter", metavar="FILE",
+                        help="bloom filter written by index.py to skip "
+                        "database lookups for unknown hashes. Default: "
+                        "DB.bloom, if it exists")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="don't use a prefilter")
+    # parser.add_argument("--list-libraries", action="store_true",
+    #                     help="list all known libraries")
+    parser.add_argument("--filter", choices=["none", "size", "name"],
+                        default="size",
+                        help="only hash files whose size (size), or basename "
+                        "and size (name), occur in the database. 'size' never "
+                        "misses an exact match, 'name' misses renamed copies. "
+                        "Default: size")
+    parser.add_argument("--normalized", choices=["whitespace", "full"],
+                        help="look up files whose exact hash is unknown by "
+                        "a normalized hash, to find reformatted copies. "
+                        "whitespace: ignore whitespace and line ends. full: "
+                        "also ignore comments and formatting. Only files "
+                        "with an indexed name are normalized. Needs a "
+                        "database built with index.py --normalized")
+    parser.add_argument("--similarity", type=float, metavar="MIN",
+                        help="report files without exact or normalized match "
+                        "that are at least MIN (0..1) similar to an indexed "
+                        "file, for example 0.8. Finds patched copies. Only "
+                        "files with an indexed name are compared. Needs a "
+                        "database built with index.py --minhash")
+    parser.add_argument("--amalgamations", action="store_true",
+                        help="search large files (at least "
+                        f"{AMALGAMATION_SIZE // 1024} KiB) without exact "
+                        "match for indexed files, to find libraries "
+                        "concatenated into a single file. Needs a database "
+                        "built with index.py --fingerprints")
+    parser.add_argument("--max-size", type=parse_size, metavar="SIZE",
+                        help="skip files larger than SIZE bytes (suffixes "
+                        "K, M, G). Files are hashed in chunks, but fallback "
+                        "lookups (--normalized, --similarity, "
+                        "--amalgamations) read whole files into memory. "
+                        "Files larger than every indexed file are only "
+                        "hashed for fallback lookups")
+    parser.add_argument("--exclude-dir", action="append", metavar="NAME",
+                        default=list(walk.DEFAULT_PRUNE),
+                        help="don't descend into directories with this name. "
+                        "Can be given multiple times. Default: "
+                        + ", ".join(walk.DEFAULT_PRUNE))
+    parser.add_argument("--follow-symlinks", action="store_true",
+                        help="descend into symlinked directories")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="persistent hash cache. Files whose path, inode, "
+                        "size and mtime are unchanged since the last scan are "
+                        "not hashed again")
+    parser.add_argument("--cache-size", type=int, default=1_000_000,
+                        metavar="N", help="maximum number of cache entries, "
+                        "least recently used entries are evicted. "
+                        "Default: 1000000")
+    parser.add_argument("-f", "--format",
+                        choices=["text", "csv", "json", "jsonl"],
+                        default="text",
+                        help="output format. jsonl writes each match as soon "
+                        "as it is found, followed by a summary per library. "
+                        "Default: text")
+    parser.add_argument("--stats", choices=["text", "json"],
+                        help="print statistics to stderr when done: files "
+                        "walked, filtered and hashed, database queries, hit "
+                        "ratio, and wall and CPU time per phase (walk, read, "
+                        "hash, lookup, report). With --connect, the server's "
+                        "statistics since it started")
+    parser.add_argument("-i", "--input", metavar="FILE",
+                        help="read additional directories/archives from FILE, "
+                        "one per line. '-' reads from stdin")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="run as a server on a unix socket, keeping the "
+                        "database, prefilters and caches loaded")
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help="let the server on SOCKET do the scanning")
+    parser.add_argument("directory", nargs="*",
+                        help="directory or archive (.tar.*, .zip, .rpm) "
+                        "containing the source code to search")
+    args = parser.parse_args(argv)
+    args.sources = [Path(d) for d in args.directory]
+    if args.input:
+        args.sources += [Path(d) for d in read_sources(args.input)]
+    if not args.sources and not args.serve:
+        parser.error("no directory given")
+    if args.serve and args.connect:
+        parser.error("--serve and --connect are mutually exclusive")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sources = args.sources
+
+    if args.format == "csv":
+        writer = CSVWriter(args.summarize,
+                           match_column=(args.normalized is not None or
+                                         args.similarity is not None or
+                                         args.amalgamations))
+    elif args.format == "json":
+        writer = JSONWriter()
+    elif args.format == "jsonl":
+        writer = JSONLinesWriter()
+    else:
+        writer = TextWriter(batch=len(sources) > 1)
+
+    if args.connect:
+        return run_client(args.connect, sources, args.summarize, writer,
+                          stream=args.format == "jsonl", stats=args.stats)
+
+    prefilter = args.prefilter or True
+    if args.no_prefilter:
+        prefilter = False
+    try:
+        scanner = Scanner(args.db, jobs=args.jobs, prefilter=prefilter,
+                          file_filter=args.filter,
+                          exclude_dirs=args.exclude_dir,
+                          follow_symlinks=args.follow_symlinks,
+                          cache=args.cache, cache_size=args.cache_size,
+                          normalized=args.normalized,
+                          similarity=args.similarity,
+                          amalgamation_size=(AMALGAMATION_SIZE
+                                             if args.amalgamations else None),
+                          max_size=args.max_size,
+                          timings=args.stats is not None)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"error: {args.db}: {e}", file=sys.stderr)
+        return 1
+
+    # The DB connection, prefilter and thread pool are shared by all sources.
+    stats = scanner.stats
+    with scanner:
+        if args.serve:
+            exit_code = serve(scanner, args.serve)
+            if args.stats:
+                print_stats(stats.as_dict(), args.stats)
+            return exit_code
+        exit_code = 0
+        for directory in sources:
+            if not directory.exists():
+                print(f"error: {directory}: no such file or directory",
+                      file=sys.stderr)
+                exit_code = 1
+                continue
+            package = package_name(directory)
+            try:
+                if args.format == "jsonl":
+                    results = scanner.stream(directory, args.summarize)
+                else:
+                    results = scanner.scan_results(directory, args.summarize)
+                for r in results:
+                    t = stats.clock()
+                    writer.write(package, *r)
+                    stats.lap("report", t)
+            except archive.ARCHIVE_ERRORS as e:
+                print(f"error: {directory}: {e}", file=sys.stderr)
+                exit_code = 1
+                continue
+            t = stats.clock()
+            sys.stdout.flush()
+            stats.lap("report", t)
+        t = stats.clock()
+        writer.close()
+        stats.lap("report", t)
+        if args.stats:
+            print_stats(stats.as_dict(), args.stats)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 # vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
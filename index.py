@@ -5,12 +5,18 @@ import concurrent.futures
 from concurrent.futures import ProcessPoolExecutor
 import datetime
 import hashlib
+import json
 import multiprocessing
 import sqlite3
 import sys
 
 from git import GitRepo
+import bloom
 import config
+import db
+import minhash
+import normalize
+import winnow
 
 
 # Types
@@ -21,28 +27,26 @@ FileRecord = collections.namedtuple('FileRecord', ['sha256',
                                                    'commit_desc',
                                                    'path',
                                                    'size', ])
-
-SCHEMA = '''
-CREATE TABLE IF NOT EXISTS files (
-    sha256      TEXT,
-    library     TEXT,     -- name of the library
-    commit_hash TEXT,     -- git commit that introduced this version
-    commit_time TEXT,     -- git commit timestamp (ISO 8601 format)
-    commit_desc TEXT,     -- git describe for this commit,
-                          -- ... falls back to: 0^{date}.{commit_hash}
-    path        TEXT,     -- file path at the time of the matched commit
-    size        INTEGER
-);
-CREATE INDEX IF NOT EXISTS files_sha256_index ON files(sha256);
-CREATE INDEX IF NOT EXISTS files_library_index ON files(library);
-
-CREATE TABLE IF NOT EXISTS libraries (  -- not implemented
-    library     TEXT PRIMARY KEY,
-    git_remote  TEXT,     -- git remote URI
-    summary     TEXT      -- short summary of the library
-);
-'''
-
+# Optional data derived from a blob, see --normalized and --minhash
+BlobExtras = collections.namedtuple('BlobExtras', ['sha256',
+                                                   'whitespace_sha256',
+                                                   'normalized_sha256',
+                                                   'signature',
+                                                   'fingerprints', ])
+# What a run adds to a library's rows. tips: {ref: commit_hash} to record.
+# descriptions: GitRepo.describe_all() of the library. indexed_tips:
+# commits of the previous run whose history is already indexed, None to
+# rebuild the library. removed: indexed commits that are no longer
+# reachable. redescribe: indexed commits whose description changed, None if
+# all of them have to be checked. indexed_tags: {tag: commit_hash} of the
+# previous run, whose containment is still valid unless the tag moved.
+IndexUpdate = collections.namedtuple('IndexUpdate', ['tips',
+                                                     'settings',
+                                                     'descriptions',
+                                                     'indexed_tips',
+                                                     'removed',
+                                                     'redescribe',
+                                                     'indexed_tags', ])
 
 # CLI
 parser = argparse.ArgumentParser()
@@ -51,15 +55,36 @@ parser.add_argument("-d", help="database path. Default: ./idlib.sqlite",
 parser.add_argument("-l", "--library", help="index only a specific library")
 parser.add_argument("--prune-only", action="store_true",
                     help="only prune the database")
+parser.add_argument("--rebuild", action="store_true",
+                    help="reindex the whole history, not just the commits "
+                    "added since the last run")
 parser.add_argument("--no-prune", action="store_true",
                     help="don't prune the database")
+parser.add_argument("--no-prefilter", action="store_true",
+                    help="don't write the prefilter (DB.bloom)")
+parser.add_argument("--state", metavar="FILE",
+                    help="indexer state for incremental runs, not needed by "
+                    "identify.py. Default: DB.state")
 parser.add_argument("-m", "--mode",
                     choices=["sparse", "full"], default="sparse",
                     help="index mode (default: sparse)")
+parser.add_argument("--normalized", choices=["whitespace", "full"],
+                    help="also store hashes of the normalized files, so "
+                    "identify.py --normalized finds reformatted copies. "
+                    "whitespace: ignore whitespace and line ends. full: also "
+                    "ignore comments and formatting (slow)")
+parser.add_argument("--minhash", action="store_true",
+                    help="also store MinHash signatures, so identify.py "
+                    "--similarity finds patched copies (slow)")
+parser.add_argument("--fingerprints", action="store_true",
+                    help="also store winnowed fingerprints, so identify.py "
+                    "--amalgamations finds files concatenated into "
+                    "amalgamations (slow, large)")
 parser.add_argument("-v", "--verbose", action="store_true")
 parser.add_argument("--max-workers", type=int,
                     default=multiprocessing.cpu_count())
 args = parser.parse_args()
+args.state = args.state or f"{args.db}.state"
 
 if args.library:
     libraries = list(filter(lambda lib: lib.name == args.library,
@@ -89,54 +114,230 @@ print()
 
 # Setup database
 con = sqlite3.connect(args.db)
-cur = con.executescript(SCHEMA)
+db_version = db.schema_version(con)
+if db_version not in (0, db.SCHEMA_VERSION):
+    print(f"{args.db}: schema version {db_version}, expected "
+          f"{db.SCHEMA_VERSION}. Run ./migrate.py -d {args.db}",
+          file=sys.stderr)
+    sys.exit(1)
+db.create(con)
+# before any change, so the prefilter of the old contents no longer matches,
+# even if this run doesn't finish
+db.new_generation(con)
+if not args.prune_only:
+    state_con = sqlite3.connect(args.state)
+    db.create_state(state_con)
+    if db_version == 0:
+        # the state of a previous database doesn't apply to a new one
+        state_con.execute("DELETE FROM indexed_refs")
+        state_con.execute("DELETE FROM descriptions")
+        state_con.commit()
+    state_con.close()
+    con.execute("ATTACH DATABASE ? AS state", (args.state,))
 sqlite3.register_adapter(datetime.datetime, lambda dt: dt.isoformat())
 
-git = None  # set by the initializer of each forked worker process
+# Files per work unit of the worker processes
+WORK_UNIT_FILES = 1000
+
+# Set by the initializer of each forked worker process
+git = None
+cache_con = None  # read-only connection, with the blob cache (state.blobs)
+blob_digests = {}  # oid -> (sha256, size) of the blobs seen by this worker
+extras_done = set()  # sha256 of the blobs whose extras this worker computed
 
 
 # Functions
-def get_filerecords(lib_name, commitinfo):
+def get_filerecords(lib_name, commitinfo, normalized=None, signatures=False,
+                    fingerprints=False):
+    """Returns the FileRecords of a commit, the BlobExtras of its files if
+    normalized, signatures or fingerprints is set and the database lacks
+    them, and the (oid, sha256, size) of the blobs that had to be hashed.
+
+    Blobs in the blob cache aren't read, unless their extras are missing."""
     global git
     result = []
-    commit_hash, commit_time, paths, _ = commitinfo
-    commit_desc = git.describe(commit_hash)
-    if not commit_desc:
-        commit_desc = "0^" + commit_time.strftime("%Y%m%d.") + commit_hash
+    extras = []
+    hashed = []
+    commit_hash, commit_time, paths, commit_desc = commitinfo
     for path in paths:
-        blob = git.file_bytes_at_commit(commit_hash, path)
-        file_size = len(blob)
-        m = hashlib.sha256()
-        m.update(blob)
-        sha256 = m.hexdigest()
+        blob_id = git.blob_id(commit_hash, path)
+        blob = None
+        digest = cached_digest(blob_id.raw)
+        if digest is None:
+            blob = git.blob_bytes(blob_id)
+            digest = (hashlib.sha256(blob).digest(), len(blob))
+            blob_digests[blob_id.raw] = digest
+            hashed.append((blob_id.raw,) + digest)
+        sha256, file_size = digest
+        if ((normalized or signatures or fingerprints) and
+                not has_extras(sha256, normalized, signatures, fingerprints)):
+            if blob is None:
+                blob = git.blob_bytes(blob_id)
+            extras.append(blob_extras(sha256, blob, normalized, signatures,
+                                      fingerprints))
+            extras_done.add(sha256)
         result.append(FileRecord(sha256=sha256,
                                  library=lib_name,
                                  commit_hash=commit_hash,
-                                 commit_time=commit_time,
+                                 commit_time=commit_time.isoformat(),
                                  commit_desc=commit_desc,
                                  path=path,
                                  size=file_size,
                                  ))
     # print(f"{cnt_commits}/{len(commits)} commits  {cnt_hashes} hashes",
     #       end='\r')
-    return result
+    return result, extras, hashed
+
+
+def cached_digest(oid):
+    """(sha256, size) of a blob from this worker's or the database's blob
+    cache, None if it was never hashed."""
+    digest = blob_digests.get(oid)
+    if digest is None:
+        digest = cache_con.execute("SELECT sha256, size FROM state.blobs "
+                                   "WHERE oid = ?", (oid,)).fetchone()
+        if digest is not None:
+            blob_digests[oid] = digest
+    return digest
+
+
+def has_extras(sha256, normalized, signatures, fingerprints):
+    """True if this worker or a previous run computed the requested extras
+    of a blob."""
+    if sha256 in extras_done:
+        return True
+    if normalized:
+        row = cache_con.execute("SELECT normalized_sha256 FROM normalized "
+                                "WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None or (normalized == "full" and row[0] is None):
+            return False
+    for table, wanted in (("minhash", signatures),
+                          ("fingerprinted", fingerprints)):
+        if wanted and cache_con.execute(f"SELECT 1 FROM {table} "
+                                        "WHERE sha256 = ?",
+                                        (sha256,)).fetchone() is None:
+            return False
+    return True
+
+
+def describe(git, descriptions, commit_hash, commit_time):
+    """git describe from GitRepo.describe_all(), falls back to
+    0^{date}.{commit_hash}."""
+    tag, depth = descriptions.get(commit_hash, (None, 0))
+    if tag is None:
+        return "0^" + commit_time.strftime("%Y%m%d.") + commit_hash
+    return git.format_describe(commit_hash, tag, depth)
+
+
+def with_descriptions(git, descriptions, commitinfos):
+    """CommitInfos with commit_desc, so the workers don't describe."""
+    return [ci._replace(commit_desc=describe(git, descriptions,
+                                             ci.commit_hash, ci.commit_time))
+            for ci in commitinfos]
+
+
+def blob_extras(sha256, blob, normalized, signatures, fingerprints):
+    whitespace_sha256 = normalized_sha256 = signature = hashes = None
+    if normalized:
+        whitespace_sha256 = hashlib.sha256(
+                normalize.normalize_whitespace(blob)).digest()
+    if normalized == "full":
+        normalized_sha256 = hashlib.sha256(normalize.normalize(blob)).digest()
+    if signatures:
+        # b"" records that the blob is too short for a signature
+        signature = minhash.signature(blob) or b""
+    if fingerprints:
+        hashes = winnow.fingerprints(blob)
+    return BlobExtras(sha256, whitespace_sha256, normalized_sha256, signature,
+                      hashes)
+
+
+def get_unit_filerecords(lib_name, unit, normalized=None, signatures=False,
+                         fingerprints=False):
+    """get_filerecords() of every commit of a work unit, as one result."""
+    result = []
+    extras = []
+    hashed = []
+    for commitinfo in unit:
+        records, blob_extras, blobs = get_filerecords(
+                lib_name, commitinfo, normalized, signatures, fingerprints)
+        result += records
+        extras += blob_extras
+        hashed += blobs
+    return result, extras, hashed
+
+
+def work_units(commitinfos, size=WORK_UNIT_FILES):
+    """Groups the CommitInfos into lists of about size files. Commits with
+    more files are split."""
+    unit = []
+    num_files = 0
+    for ci in commitinfos:
+        for i in range(0, len(ci.paths), size):
+            part = ci._replace(paths=ci.paths[i:i + size])
+            unit.append(part)
+            num_files += len(part.paths)
+            if num_files >= size:
+                yield unit
+                unit = []
+                num_files = 0
+    if unit:
+        yield unit
 
 
 def get_all_filerecords(repo_path, lib_name, commitinfos, max_workers):
-    result = []
+    """Yields the (FileRecords, BlobExtras, hashed blobs) of the work units
+    as the workers finish them. At most 2 * max_workers units are in
+    flight, so results don't pile up when the database is slower than the
+    workers."""
 
     def process_init(repo_path):
-        global git
+        global git, cache_con
         git = GitRepo(repo_path)
+        cache_con = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        cache_con.execute("ATTACH DATABASE ? AS state",
+                          (f"file:{args.state}?mode=ro",))
 
     with ProcessPoolExecutor(max_workers=max_workers,
                              initializer=process_init,
                              initargs=(repo_path,)) as executor:
-        futures = [executor.submit(get_filerecords, lib_name, ci) for ci in
-                   commitinfos]
-        for future in concurrent.futures.as_completed(futures):
-            result += future.result()
-    return result
+        pending = set()
+        for unit in work_units(commitinfos):
+            if len(pending) >= 2 * max_workers:
+                done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(get_unit_filerecords, lib_name, unit,
+                                        args.normalized, args.minhash,
+                                        args.fingerprints))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def insert_filerecords(lib, commitinfos, max_workers):
+    """Inserts the results of get_all_filerecords() as they arrive, one
+    transaction per work unit, and prints the totals."""
+    counts = collections.Counter()
+    cur = con.cursor()
+    for records, extras, hashed in get_all_filerecords(
+            lib.path, lib.name, commitinfos, max_workers):
+        cur.executemany('''INSERT OR IGNORE INTO files
+                           VALUES (?,?,?,?,?,?,?)''', records)
+        insert_extras(cur, extras, counts)
+        cur.executemany("INSERT OR IGNORE INTO state.blobs VALUES (?,?,?)",
+                        hashed)
+        con.commit()
+        counts["files"] += len(records)
+        counts["hashed"] += len(hashed)
+    for key, text in (("normalized", "normalized hashes"),
+                      ("signatures", "MinHash signatures"),
+                      ("fingerprints", "fingerprinted files")):
+        if counts[key]:
+            print(f"- {counts[key]} {text}")
+    print(f"- hashed {counts['hashed']} blobs, "
+          f"{counts['files'] - counts['hashed']} files from the blob cache")
 
 
 def index_full(max_workers):
@@ -144,18 +345,20 @@ def index_full(max_workers):
         print(f"Indexing library: {lib.name}")
         sys.stdout.flush()
         git = GitRepo(lib.path)
+        update = plan_update(lib, git)
         print("- fetching list of all commits")
-        commitinfos = git.all_commits_with_metadata()
+        commitinfos = with_descriptions(
+                git, update.descriptions, git.all_commits_with_metadata(
+                    exclude=update.indexed_tips or ()))
         num_files = 0
         for ci in commitinfos:
             num_files += len(ci.paths)
         print(f"- found {num_files} files in {len(commitinfos)} commits")
-        filerecords = get_all_filerecords(lib.path, lib.name, commitinfos,
-                                          max_workers=max_workers)
-        cur = con.cursor()
-        cur.execute('DELETE FROM files WHERE library = ?', (lib.name,))
-        cur.executemany('''INSERT INTO files VALUES (?,?,?,?,?,?,?)''',
-                        filerecords)
+        apply_update(con.cursor(), lib, git, update)
+        con.commit()
+        insert_filerecords(lib, commitinfos, max_workers)
+        index_releases(lib, update)
+        save_state(con.cursor(), lib, update)
         con.commit()
         print()
         sys.stdout.flush()
@@ -166,23 +369,254 @@ def index_sparse(max_workers):
         print(f"Indexing library: {lib.name}")
         sys.stdout.flush()
         git = GitRepo(lib.path)
-        filerecords = []
+        update = plan_update(lib, git)
+        commitinfos = []
         for p in lib.sparse_paths:
-            commitinfos = git.all_commits_with_metadata(path=p)
-            print(f"- found {len(commitinfos)} versions of {p}")
+            versions = git.all_commits_with_metadata(
+                    path=p, exclude=update.indexed_tips or ())
+            print(f"- found {len(versions)} versions of {p}")
             sys.stdout.flush()
-            filerecords += get_all_filerecords(lib.path, lib.name, commitinfos,
-                                               max_workers=max_workers)
-        print(f"- total {len(filerecords)} files")
-        cur = con.cursor()
-        cur.execute('DELETE FROM files WHERE library = ?', (lib.name,))
-        cur.executemany('''INSERT INTO files VALUES (?,?,?,?,?,?,?)''',
-                        filerecords)
+            commitinfos += with_descriptions(git, update.descriptions,
+                                             versions)
+        print(f"- total {sum(len(ci.paths) for ci in commitinfos)} files")
+        apply_update(con.cursor(), lib, git, update)
+        con.commit()
+        insert_filerecords(lib, commitinfos, max_workers)
+        index_releases(lib, update)
+        save_state(con.cursor(), lib, update)
         con.commit()
         print()
         sys.stdout.flush()
 
 
+def index_settings(lib):
+    """The options a library is indexed with, as JSON. Only a run with the
+    same settings can add to the rows of a previous run."""
+    settings = {"mode": args.mode, "normalized": args.normalized,
+                "minhash": args.minhash, "fingerprints": args.fingerprints}
+    if args.mode == 'sparse':
+        settings["paths"] = sorted(str(p) for p in lib.sparse_paths)
+    return json.dumps(settings, sort_keys=True)
+
+
+def plan_update(lib, git):
+    """Compares the ref tips of a library with those of the previous run.
+    Returns an IndexUpdate, a rebuild if there is nothing to build on."""
+    tips = git.ref_tips()
+    settings = index_settings(lib)
+    rows = con.execute("SELECT ref, commit_hash, settings "
+                       "FROM state.indexed_refs WHERE library = ?",
+                       (lib.name,)).fetchall()
+    indexed = {ref: commit_hash for ref, commit_hash, _ in rows}
+
+    # the description of a commit depends on the tags of its ancestors:
+    # those of commits with added, moved or deleted tags are recomputed
+    known = {}
+    if not args.rebuild:
+        known = {commit_hash: (tag, depth) for commit_hash, tag, depth in
+                 con.execute("SELECT commit_hash, tag, depth "
+                             "FROM state.descriptions WHERE library = ?",
+                             (lib.name,))}
+    stale = {commit_hash for ref, commit_hash
+             in set(indexed.items()) ^ set(tips.items())
+             if ref.startswith('refs/tags/')}
+    descriptions = git.describe_all(known, stale)
+    print(f"- described {len(descriptions)} commits")
+    redescribe = None
+    if known:
+        redescribe = {commit_hash for commit_hash, old in known.items()
+                      if descriptions.get(commit_hash, old) != old}
+
+    rebuild = IndexUpdate(tips, settings, descriptions, None, [], None, {})
+    if args.rebuild or not rows:
+        return rebuild
+    if any(row_settings != settings for _, _, row_settings in rows):
+        print("- index settings changed, rebuilding")
+        return rebuild
+    indexed_tips = sorted(set(indexed.values()))
+    if not all(git.has_commit(commit_hash) for commit_hash in indexed_tips):
+        print("- previously indexed commits are gone, rebuilding")
+        return rebuild
+    # rewritten history: commits that no ref leads to anymore
+    removed = git.rev_list(indexed_tips, exclude=set(tips.values()))
+    print(f"- indexing commits since the previous run "
+          f"({len(indexed_tips)} ref tips)")
+    indexed_tags = {ref[len('refs/tags/'):]: commit_hash
+                    for ref, commit_hash in indexed.items()
+                    if ref.startswith('refs/tags/')}
+    return IndexUpdate(tips, settings, descriptions, indexed_tips, removed,
+                       redescribe, indexed_tags)
+
+
+def apply_update(cur, lib, git, update):
+    """Removes the rows that a run replaces: all rows of the library for a
+    rebuild, else the rows of unreachable commits. Updates the commit_desc
+    of commits whose description changed.
+
+    Forgets the recorded ref tips and descriptions until save_state(), so
+    the next run rebuilds the library if this one is interrupted."""
+    cur.execute("DELETE FROM state.indexed_refs WHERE library = ?",
+                (lib.name,))
+    cur.execute("DELETE FROM state.descriptions WHERE library = ?",
+                (lib.name,))
+    if update.indexed_tips is None:
+        cur.execute('DELETE FROM files WHERE library = ?', (lib.name,))
+        return
+    if update.removed:
+        cur.executemany('DELETE FROM files '
+                        'WHERE library = ? AND commit_hash = ?',
+                        [(lib.name, commit_hash)
+                         for commit_hash in update.removed])
+        print(f"- deleted {len(update.removed)} commits of rewritten "
+              "history")
+    if update.redescribe is not None and not update.redescribe:
+        return
+    changed = []
+    for commit_hash, commit_time, commit_desc in cur.execute(
+            "SELECT DISTINCT commit_hash, commit_time, commit_desc "
+            "FROM files WHERE library = ?", (lib.name,)).fetchall():
+        if (update.redescribe is not None and
+                commit_hash not in update.redescribe):
+            continue
+        desc = describe(git, update.descriptions, commit_hash,
+                        datetime.datetime.fromisoformat(commit_time))
+        if desc != commit_desc:
+            changed.append((desc, lib.name, commit_hash))
+    cur.executemany('UPDATE files SET commit_desc = ? '
+                    'WHERE library = ? AND commit_hash = ?', changed)
+    if changed:
+        print(f"- updated the versions of {len(changed)} commits")
+
+
+def save_state(cur, lib, update):
+    """Records the ref tips and descriptions for the next run."""
+    cur.executemany("INSERT INTO state.indexed_refs VALUES (?,?,?,?)",
+                    [(lib.name, ref, commit_hash, update.settings)
+                     for ref, commit_hash in sorted(update.tips.items())])
+    cur.executemany("INSERT INTO state.descriptions VALUES (?,?,?,?)",
+                    [(lib.name, commit_hash, tag, depth) for commit_hash,
+                     (tag, depth) in update.descriptions.items()])
+
+
+def insert_extras(cur, extras, counts):
+    """Inserts the BlobExtras and adds their numbers to counts."""
+    normalized = [(e.sha256, e.whitespace_sha256, e.normalized_sha256)
+                  for e in extras if e.whitespace_sha256 is not None]
+    counts["normalized"] += len(normalized)
+    # REPLACE, so a full index upgrades rows of a whitespace-only index
+    cur.executemany("INSERT OR REPLACE INTO normalized VALUES (?,?,?)",
+                    normalized)
+    signatures = {e.sha256: e.signature for e in extras
+                  if e.signature is not None}
+    counts["signatures"] += len(signatures)
+    cur.executemany("INSERT OR REPLACE INTO minhash VALUES (?,?)",
+                    signatures.items())
+    cur.executemany("INSERT OR IGNORE INTO lsh VALUES (?,?,?)",
+                    [(band, key, sha256)
+                     for sha256, sig in signatures.items() if sig
+                     for band, key in minhash.bands(sig)])
+    # files without fingerprints get a row with count 0 as well, so
+    # has_extras() doesn't compute them again
+    fingerprints = {e.sha256: e.fingerprints for e in extras
+                    if e.fingerprints is not None}
+    counts["fingerprints"] += len(fingerprints)
+    cur.executemany("INSERT OR REPLACE INTO fingerprinted VALUES (?,?)",
+                    [(sha256, len(hashes))
+                     for sha256, hashes in fingerprints.items()])
+    cur.executemany("INSERT OR IGNORE INTO fingerprints VALUES (?,?)",
+                    [(h, sha256) for sha256, hashes in fingerprints.items()
+                     for h in hashes])
+
+
+def index_releases(lib, update):
+    """Fills releases and containment for a library: for every indexed
+    blob, a bitmap of the tagged releases whose trees contain it.
+
+    In full mode, the bits of releases whose tag didn't move since the
+    previous run are taken from the existing bitmaps: every blob of their
+    trees was indexed then. Only the trees of added and moved tags are
+    walked. In sparse mode, a run can add paths that weren't looked up in
+    the older releases, so all of them are looked up again."""
+    git = GitRepo(lib.path)
+    tags = git.tags()
+    cur = con.cursor()
+    indexed = {sha256 for (sha256,) in cur.execute(
+        "SELECT DISTINCT sha256 FROM files WHERE library = ?", (lib.name,))}
+    paths = None  # full mode: all files of each release
+    if args.mode == 'sparse':
+        paths = [path for (path,) in cur.execute(
+            "SELECT DISTINCT path FROM files WHERE library = ?", (lib.name,))]
+    bitmaps = {}
+    kept = {}  # bit in the existing bitmaps -> bit in the new ones
+    if args.mode == 'full' and update.indexed_tags:
+        old_ids = {tag: i for i, tag in cur.execute(
+            "SELECT id, tag FROM releases WHERE library = ?", (lib.name,))}
+        kept = {old_ids[tag]: i for i, (tag, commit_hash, _) in enumerate(tags)
+                if tag in old_ids and
+                update.indexed_tags.get(tag) == commit_hash}
+        bitmaps = reused_bitmaps(cur, lib, indexed, kept)
+    print(f"- computing containment for {len(tags) - len(kept)} of "
+          f"{len(tags)} releases")
+    sys.stdout.flush()
+    digests = {}  # blob id -> sha256, most blobs occur in many releases
+    hashed = []
+    reused = set(kept.values())
+    for i, (tag, commit_hash, _) in enumerate(tags):
+        if i in reused:
+            continue
+        for path, blob_id in git.tree_blobs(commit_hash, paths):
+            sha256 = digests.get(blob_id)
+            if sha256 is None:
+                row = cur.execute("SELECT sha256 FROM state.blobs "
+                                  "WHERE oid = ?", (blob_id.raw,)).fetchone()
+                if row is not None:
+                    sha256 = row[0]
+                else:
+                    blob = git.blob_bytes(blob_id)
+                    sha256 = hashlib.sha256(blob).digest()
+                    hashed.append((blob_id.raw, sha256, len(blob)))
+                digests[blob_id] = sha256
+            if sha256 in indexed:
+                bitmaps[sha256] = bitmaps.get(sha256, 0) | (1 << i)
+    num_bytes = (len(tags) + 7) // 8
+    cur.execute("DELETE FROM releases WHERE library = ?", (lib.name,))
+    cur.executemany("INSERT INTO releases VALUES (?,?,?,?)",
+                    [(lib.name, i, tag, commit_time) for i, (tag, _,
+                     commit_time) in enumerate(tags)])
+    cur.execute("DELETE FROM containment WHERE library = ?", (lib.name,))
+    cur.executemany("INSERT INTO containment VALUES (?,?,?)",
+                    [(sha256, lib.name, bits.to_bytes(num_bytes, 'little'))
+                     for sha256, bits in bitmaps.items()])
+    cur.executemany("INSERT OR IGNORE INTO state.blobs VALUES (?,?,?)",
+                    hashed)
+    con.commit()
+    print(f"- {len(bitmaps)} of {len(indexed)} files are part of a release")
+
+
+def reused_bitmaps(cur, lib, indexed, kept):
+    """The existing containment bitmaps of the indexed blobs, reduced to the
+    releases in kept ({old bit: new bit})."""
+    result = {}
+    mask = sum(1 << old for old in kept)
+    # usually new tags are the newest, and the kept bits don't move
+    shifted = any(old != new for old, new in kept.items())
+    for sha256, releases in cur.execute(
+            "SELECT sha256, releases FROM containment WHERE library = ?",
+            (lib.name,)).fetchall():
+        if sha256 not in indexed:
+            continue
+        old_bits = int.from_bytes(releases, 'little') & mask
+        bits = old_bits
+        if shifted:
+            bits = 0
+            for old, new in kept.items():
+                if old_bits >> old & 1:
+                    bits |= 1 << new
+        if bits:
+            result[sha256] = bits
+    return result
+
+
 def prune():
     cur = con.cursor()
     print("Pruning database...")
@@ -205,9 +639,9 @@ def prune():
             for row in rows:
                 lib, sha256, path = row
                 to_delete.append((sha256, lib))
-                print(f"    - delete in {a_lib}: {sha256} {path}")
+                print(f"    - delete in {a_lib}: {sha256.hex()} {path}")
             for sha256, lib in to_delete:
-                cur.execute("DELETE FROM files"
+                cur.execute("DELETE FROM files "
                             "WHERE sha256 = ? AND library = ?", (sha256, lib))
     con.commit()
 
@@ -223,17 +657,53 @@ def prune():
     for row in rows:
         a_lib, b_lib, sha256, a_path = row
         to_delete.append(sha256)
-        print(f"  - delete duplicate: ({a_lib} <--> {b_lib}) {sha256} {a_path}")
+        print(f"  - delete duplicate: ({a_lib} <--> {b_lib}) {sha256.hex()} "
+              f"{a_path}")
     for sha256 in to_delete:
         cur.execute("DELETE FROM files WHERE sha256 = ?", (sha256,))
     con.commit()
 
+    print("- delete normalized hashes, signatures and fingerprints of "
+          "deleted files")
+    cur.execute("DELETE FROM normalized "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM files)")
+    print(f"  - deleted {cur.rowcount} normalized hashes")
+    cur.execute("DELETE FROM minhash "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM files)")
+    print(f"  - deleted {cur.rowcount} MinHash signatures")
+    cur.execute("DELETE FROM lsh "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM minhash)")
+    cur.execute("DELETE FROM fingerprinted "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM files)")
+    print(f"  - deleted fingerprints of {cur.rowcount} files")
+    cur.execute("DELETE FROM fingerprints "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM fingerprinted)")
+    con.commit()
+
+    print("- delete release bitmaps of deleted files")
+    cur.execute("DELETE FROM containment WHERE NOT EXISTS ("
+                "SELECT 1 FROM files WHERE files.sha256 = containment.sha256 "
+                "AND files.library = containment.library)")
+    print(f"  - deleted {cur.rowcount} bitmaps")
+    cur.execute("DELETE FROM releases "
+                "WHERE library NOT IN (SELECT library FROM containment)")
+    print(f"  - deleted {cur.rowcount} releases of libraries without files")
+    con.commit()
+
     print("- vacuum")
     cur = con.cursor()
     cur.execute("VACUUM;")
     con.commit()
 
 
+def write_prefilter(path):
+    print(f"Writing prefilter {path}")
+    bf = bloom.build(con)
+    bf.write(path)
+    print(f"- {bf.num_keys} hashes, {bf.num_bits // 8} bytes, "
+          f"{bf.num_hashes} probes")
+
+
 # Main
 if not args.prune_only:
     if args.mode == 'sparse':
@@ -243,5 +713,11 @@ if not args.prune_only:
 if not args.no_prune:
     print()
     prune()
+print()
+print("Updating file names and sizes")
+db.update_names(con)
+if not args.no_prefilter:
+    print()
+    write_prefilter(f"{args.db}.bloom")
 
 # vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
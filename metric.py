@@ -70,6 +70,7 @@ import re
 import sys
 
 from git import GitRepo
+import walk
 
 
 # Types
@@ -151,9 +152,8 @@ def evaluate_all(git, paths):
 print("This may take a long time.")
 paths = []
 re_cc_filename = re.compile(r'.*\.(c|cc|cpp|cxx|h|hh|hpp|hxx)$', re.I)
-for path in repo_path.glob('**/*'):
-    if re_cc_filename.match(path.name) and path.is_file():
-        paths.append(path.relative_to(repo_path))
+for path, _ in walk.files(repo_path, re_cc_filename.match):
+    paths.append(Path(path).relative_to(repo_path))
 print(f"Evaluating {len(paths)} files...")
 sys.stdout.flush()
 
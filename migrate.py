@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Upgrade an existing database to the current schema in place."""
+import argparse
+import sqlite3
+import sys
+
+import db
+
+
+parser = argparse.ArgumentParser(
+        prog="migrate.py",
+        description="Upgrade an idlib database to the current schema")
+parser.add_argument("-d", help="database path. Default: ./idlib.sqlite",
+                    dest="db", default='idlib.sqlite')
+parser.add_argument("--no-vacuum", action="store_true",
+                    help="don't vacuum the database after migrating")
+args = parser.parse_args()
+
+con = sqlite3.connect(f"file:{args.db}?mode=rw", uri=True)
+version = db.schema_version(con)
+if version == 0:
+    print(f"{args.db}: empty database, nothing to migrate", file=sys.stderr)
+    sys.exit(1)
+if version > db.SCHEMA_VERSION:
+    print(f"{args.db}: unknown schema version {version}", file=sys.stderr)
+    sys.exit(1)
+if version == db.SCHEMA_VERSION:
+    print(f"{args.db}: already at schema version {version}")
+    sys.exit(0)
+
+if version == 1:
+    print(f"{args.db}: migrating schema version 1 -> 2")
+    db.migrate_v1_to_v2(con)
+
+if not args.no_vacuum:
+    print("- vacuum")
+    con.execute("VACUUM")
+con.close()
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
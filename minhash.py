@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""MinHash signatures and LSH banding for similarity lookups.
+
+A file is represented by the set of its token shingles (SHINGLE consecutive
+tokens of normalize.tokens(), so comments and formatting don't matter). The
+fraction of equal positions in two signatures estimates the Jaccard
+similarity of the shingle sets.
+
+The signature uses one permutation hashing: every shingle is hashed once,
+the low bits pick one of NUM_PERM bins, the other bits are the value, and
+each bin keeps its minimum. Empty bins (small files) take the value of the
+next non-empty bin plus a distance offset ("rotation" densification). This
+costs one hash per shingle instead of NUM_PERM.
+
+For LSH, the signature is cut into BANDS bands of ROWS values. Files sharing
+at least one band are candidates; with 16 bands of 4 values, a file with
+similarity 0.8 becomes a candidate with probability 0.9998, one with
+similarity 0.5 with probability 0.64, and unrelated files almost never.
+"""
+import hashlib
+import struct
+
+import normalize
+
+
+SHINGLE = 5
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+_BIN_BITS = 6  # log2(NUM_PERM)
+_VALUE_BITS = 26  # + _BIN_BITS bits for the densification distance = 32
+_VALUE_MASK = (1 << _VALUE_BITS) - 1
+_EMPTY = 1 << 32
+_SIGNATURE = struct.Struct(f"<{NUM_PERM}I")
+BAND_SIZE = ROWS * 4  # bytes
+
+
+def signature(data):
+    """MinHash signature (bytes) of C/C++ source code, None if it has fewer
+    than SHINGLE tokens."""
+    tokens = normalize.tokens(data)
+    if len(tokens) < SHINGLE:
+        return None
+    bins = [_EMPTY] * NUM_PERM
+    blake2b = hashlib.blake2b
+    for shingle in {b" ".join(tokens[i:i + SHINGLE])
+                    for i in range(len(tokens) - SHINGLE + 1)}:
+        h = int.from_bytes(blake2b(shingle, digest_size=8).digest(), "little")
+        b = h & (NUM_PERM - 1)
+        value = (h >> _BIN_BITS) & _VALUE_MASK
+        if value < bins[b]:
+            bins[b] = value
+    # densification: copy from the next non-empty bin, cyclically
+    for i in range(NUM_PERM):
+        if bins[i] != _EMPTY:
+            continue
+        for distance in range(1, NUM_PERM):
+            donor = bins[(i + distance) % NUM_PERM]
+            if donor != _EMPTY and donor <= _VALUE_MASK:
+                bins[i] = donor | (distance << _VALUE_BITS)
+                break
+    return _SIGNATURE.pack(*bins)
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two signatures."""
+    same = sum(x == y for x, y in zip(_SIGNATURE.unpack(a),
+                                      _SIGNATURE.unpack(b)))
+    return same / NUM_PERM
+
+
+def bands(sig):
+    """Yields (band, key) of a signature for the lsh table."""
+    for band in range(BANDS):
+        yield band, sig[band * BAND_SIZE:(band + 1) * BAND_SIZE]
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap:
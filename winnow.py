@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Winnowed fingerprints of C/C++ source code, to find files inside
+amalgamations.
+
+A file is hashed as a sequence of K-token windows (k-grams of
+normalize.tokens(), so comments and formatting don't matter) with a
+Rabin-Karp rolling hash. Winnowing keeps the minimum hash of every W
+consecutive k-grams (Schleimer et al., "Winnowing: Local Algorithms for
+Document Fingerprinting", 2003). The selection only depends on the content
+around it, so a file concatenated into an amalgamation yields the same
+fingerprints as the file itself, except near the seams. Any common run of
+at least W + K - 1 tokens shares at least one fingerprint.
+"""
+import collections
+import hashlib
+
+import normalize
+
+
+K = 16
+W = 32
+_MOD = (1 << 61) - 1  # Mersenne prime, hashes fit into a SQLite INTEGER
+_BASE = 1_000_003
+_BASE_K = pow(_BASE, K - 1, _MOD)
+
+
+def fingerprints(data):
+    """Set of the winnowed k-gram hashes of C/C++ source code."""
+    tokens = normalize.tokens(data)
+    if len(tokens) < K:
+        return set()
+    token_hashes = {}
+    values = []
+    for token in tokens:
+        h = token_hashes.get(token)
+        if h is None:
+            h = int.from_bytes(hashlib.blake2b(token, digest_size=8).digest(),
+                               "little") % _MOD
+            token_hashes[token] = h
+        values.append(h)
+
+    result = set()
+    window = collections.deque()  # (hash, position), increasing hashes
+    h = 0
+    for i, value in enumerate(values):
+        if i >= K:
+            h = (h - values[i - K] * _BASE_K) % _MOD
+        h = (h * _BASE + value) % _MOD
+        if i < K - 1:
+            continue
+        pos = i - K + 1  # k-gram number
+        # the rightmost minimum of each window is selected
+        while window and window[-1][0] >= h:
+            window.pop()
+        window.append((h, pos))
+        if window[0][1] <= pos - W:
+            window.popleft()
+        if pos >= W - 1 or i == len(values) - 1:
+            result.add(window[0][0])
+    return result
+
+
+# vim:set expandtab tabstop=4 shiftwidth=4 softtabstop=4 nowrap: